@@ -272,6 +272,8 @@ class Cache(object):
         self.data_fn = None
         self.cacheclean = True
         self.data_hash = data_hash
+        self.syncfiles = None
+        self.synced = set()
 
         if self.cachedir in [None, '']:
             self.has_cache = False
@@ -587,35 +589,67 @@ class Cache(object):
 
         if self.cacheclean:
             logger.debug(2, "Cache is clean, not saving.")
+            self.finish_sync(False)
             return
 
-        file_dict = {}
-        pickler_dict = {}
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cache_class_name = cache_class.__name__
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                file_dict[cache_class_name] = open(cachefile, "wb")
-                pickler_dict[cache_class_name] =  pickle.Pickler(file_dict[cache_class_name], pickle.HIGHEST_PROTOCOL)
-                   
-        pickler_dict['CoreRecipeInfo'].dump(__cache_version__)
-        pickler_dict['CoreRecipeInfo'].dump(bb.__version__)
+        if self.syncfiles is None:
+            self.start_sync()
 
+        completed = False
         try:
             for key, info_array in self.depends_cache.iteritems():
-                for info in info_array:
-                    if isinstance(info, RecipeInfoCommon):
-                        cache_class_name = info.__class__.__name__
-                        pickler_dict[cache_class_name].dump(key)
-                        pickler_dict[cache_class_name].dump(info)
+                if key not in self.synced:
+                    self.write_info(key, info_array)
+            completed = True
         finally:
-            for cache_class in self.caches_array:
-                if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                    cache_class_name = cache_class.__name__
-                    file_dict[cache_class_name].close()
+            self.finish_sync(completed)
 
         del self.depends_cache
 
+    def sync_info(self, filename, info_array):
+        """
+        Write a cache entry out ahead of sync(), so that the cache file
+        can be written while parsing is still going on
+        """
+        if not self.has_cache or not self.cacheable(info_array):
+            return
+
+        if self.syncfiles is None:
+            self.start_sync()
+        self.write_info(filename, info_array)
+        self.synced.add(filename)
+
+    def start_sync(self):
+        self.syncfiles = {}
+        for cache_class in self.caches_array:
+            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
+                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
+                f = open(cachefile + ".new", "wb")
+                self.syncfiles[cache_class.__name__] = (cachefile, f, pickle.Pickler(f, pickle.HIGHEST_PROTOCOL))
+
+        pickler = self.syncfiles['CoreRecipeInfo'][2]
+        pickler.dump(__cache_version__)
+        pickler.dump(bb.__version__)
+
+    def write_info(self, filename, info_array):
+        for info in info_array:
+            if isinstance(info, RecipeInfoCommon):
+                pickler = self.syncfiles[info.__class__.__name__][2]
+                pickler.dump(filename)
+                pickler.dump(info)
+
+    def finish_sync(self, keep):
+        if self.syncfiles is None:
+            return
+
+        for cachefile, f, _ in self.syncfiles.itervalues():
+            f.close()
+            if keep:
+                os.rename(f.name, cachefile)
+            else:
+                bb.utils.remove(f.name)
+        self.syncfiles = None
+
     @staticmethod
     def mtime(cachefile):
         return bb.parse.cached_mtime_noerror(cachefile)
@@ -627,11 +661,15 @@ class Cache(object):
         if not self.has_cache:
             return
 
-        if (info_array[0].skipped or 'SRCREVINACTION' not in info_array[0].pv) and not info_array[0].nocache:
+        if self.cacheable(info_array):
             if parsed:
                 self.cacheclean = False
             self.depends_cache[filename] = info_array
 
+    @staticmethod
+    def cacheable(info_array):
+        return (info_array[0].skipped or 'SRCREVINACTION' not in info_array[0].pv) and not info_array[0].nocache
+
     def add(self, file_name, data, cacheData, parsed=None):
         """
         Save data we need into the cache
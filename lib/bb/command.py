@@ -171,6 +171,13 @@ class CommandsSync:
         return command.cooker.data.getVar(varname, expand)
     getVariable.readonly = True
 
+    def getVariables(self, command, params):
+        """
+        Read the expanded values of several variables from data
+        """
+        return [command.cooker.data.getVar(varname, True) for varname in params]
+    getVariables.readonly = True
+
     def setVariable(self, command, params):
         """
         Set the value of variable in data
@@ -178,6 +185,7 @@ class CommandsSync:
         varname = params[0]
         value = str(params[1])
         command.cooker.data.setVar(varname, value)
+        command.cooker.clearEnvdataCache()
 
     def setConfig(self, command, params):
         """
@@ -354,13 +362,24 @@ class CommandsAsync:
         """
         Find config files which provide appropriate values
         for the passed configuration variable. i.e. MACHINE
+        If a second parameter is true the result is held back until
+        flushConfigFileEvents is run
         """
         varname = params[0]
+        coalesce = len(params) > 1 and params[1]
 
-        command.cooker.findConfigFiles(varname)
+        command.cooker.findConfigFiles(varname, coalesce)
         command.finishAsyncCommand()
     findConfigFiles.needcache = False
 
+    def flushConfigFileEvents(self, command, params):
+        """
+        Send the held back findConfigFiles results as one event
+        """
+        command.cooker.flushConfigFileEvents()
+        command.finishAsyncCommand()
+    flushConfigFileEvents.needcache = False
+
     def findFilesMatchingInDir(self, command, params):
         """
         Find implementation files matching the specified pattern
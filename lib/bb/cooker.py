@@ -25,27 +25,126 @@
 from __future__ import print_function
 import sys, os, glob, os.path, re, time
 import atexit
+import bisect
+import copy
+import errno
+import gc
 import itertools
 import logging
 import multiprocessing
 import sre_constants
+import stat
 import threading
 from cStringIO import StringIO
 from contextlib import closing
 from functools import wraps
-from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from collections import defaultdict, deque, OrderedDict
 import bb, bb.exceptions, bb.command
 from bb import utils, data, parse, event, cache, providers, taskdata, runqueue
 import Queue
+import select
 import signal
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import prserv.serv
 
+try:
+    import termios
+except ImportError:
+    termios = None
+
+# scandir is part of os from Python 3.5, use the standalone module if it is
+# available on older versions
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 logger      = logging.getLogger("BitBake")
 collectlog  = logging.getLogger("BitBake.Collection")
 buildlog    = logging.getLogger("BitBake.Build")
 parselog    = logging.getLogger("BitBake.Parsing")
 providerlog = logging.getLogger("BitBake.Provider")
 
+image_basename_re = re.compile("IMAGE_BASENAME *=")
+
+recipe_suffixes = ('.bb', '.bbappend')
+
+__regex_cache = {}
+def compile_regex(pattern):
+    """
+    re.compile() with the result kept for the life of the process, the
+    BBFILE_PATTERN and BBMASK expressions are compiled again on every parse
+    """
+    if pattern not in __regex_cache:
+        __regex_cache[pattern] = re.compile(pattern)
+    return __regex_cache[pattern]
+
+def walk(top):
+    """
+    Equivalent of os.walk(top). Where scandir is available the file types
+    come with the directory entries, avoiding a stat() call per entry.
+    """
+    if not scandir:
+        for item in os.walk(top):
+            yield item
+        return
+
+    try:
+        entries = list(scandir(top))
+    except OSError:
+        return
+
+    dirs = []
+    files = []
+    links = set()
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            dirs.append(entry.name)
+            if entry.is_symlink():
+                links.add(entry.name)
+        else:
+            files.append(entry.name)
+
+    yield top, dirs, files
+
+    # dirs may have been pruned by the caller; like os.walk, don't follow
+    # symlinks to directories
+    for name in dirs:
+        if name not in links:
+            for item in walk(os.path.join(top, name)):
+                yield item
+
+def glob_dirs(pattern):
+    """
+    Return the directories glob.glob(pattern) has to list to expand pattern
+    """
+    dirs = []
+    dirname = os.path.dirname(pattern)
+    while dirname:
+        if not glob.has_magic(dirname):
+            dirs.append(dirname)
+            break
+        dirs.extend(glob.glob(dirname))
+        dirname = os.path.dirname(dirname)
+    return dirs
+
+def dir_mtime(path):
+    try:
+        return os.stat(path)[stat.ST_MTIME]
+    except OSError:
+        return None
+
 class NoSpecificMatch(bb.BBHandledException):
     """
     Exception raised when no or multiple file matches are found
@@ -61,6 +160,37 @@ class CollectionError(bb.BBHandledException):
     Exception raised when layer configuration is incorrect
     """
 
+class LogWriter(object):
+    """
+    File-like object passing what is written to it on to logger.plain() in
+    blocks of whole lines, so large outputs are never held in memory at once.
+    The combined output is the same as logging everything in a single call.
+    """
+    def __init__(self, logger, blocksize = 65536):
+        self.logger = logger
+        self.blocksize = blocksize
+        self.buf = []
+        self.size = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= self.blocksize:
+            data = "".join(self.buf)
+            end = data.rfind("\n")
+            if end == -1:
+                self.buf = [data]
+                return
+            # the log handler terminates each record with the newline
+            self.logger.plain(data[:end])
+            self.buf = [data[end+1:]]
+            self.size = len(self.buf[0])
+
+    def close(self):
+        self.logger.plain("".join(self.buf))
+        self.buf = []
+        self.size = 0
+
 class state:
     initial, parsing, running, shutdown, forceshutdown, stopped, error = range(7)
 
@@ -139,8 +269,7 @@ class BBCooker:
 
         # TOSTOP must not be set or our children will hang when they output
         fd = sys.stdout.fileno()
-        if os.isatty(fd):
-            import termios
+        if termios and os.isatty(fd):
             tcattr = termios.tcgetattr(fd)
             if tcattr[3] & termios.TOSTOP:
                 buildlog.info("The terminal had the TOSTOP bit set, clearing...")
@@ -152,6 +281,12 @@ class BBCooker:
 
         self.parser = None
 
+        self.inprogress = {}
+        self.inprogress_lock = threading.Lock()
+
+        self.inherits_cache = {}
+        self.pending_config_events = []
+
         signal.signal(signal.SIGTERM, self.sigterm_exception)
         # Let SIGHUP exit as SIGTERM
         signal.signal(signal.SIGHUP, self.sigterm_exception)
@@ -171,17 +306,49 @@ class BBCooker:
         for feature in features:
             self.featureset.setFeature(feature)
         bb.debug(1, "Features set %s (was %s)" % (original_featureset, list(self.featureset)))
-        if (original_featureset != list(self.featureset)):
+        added = set(self.featureset) - set(original_featureset)
+        # Only history tracking needs the base configuration to be parsed
+        # again. Extra caches change the cache classes in use, so the recipes
+        # have to be parsed again to fill in their fields. The remaining
+        # features are checked as they are needed.
+        if CookerFeatures.BASEDATASTORE_TRACKING in added:
             self.reset()
+        elif CookerFeatures.HOB_EXTRA_CACHES in added:
+            self.initCachesArray()
+            self.recipecache = None
+            self.state = state.initial
 
     def initConfigurationData(self):
 
         self.state = state.initial
-        self.caches_array = []
 
         if CookerFeatures.BASEDATASTORE_TRACKING in self.featureset:
             self.enableDataTracking()
 
+        self.initCachesArray()
+
+        self.databuilder = bb.cookerdata.CookerDataBuilder(self.configuration, False)
+        self.databuilder.parseBaseConfiguration()
+        self.data = self.databuilder.data
+        self.data_hash = self.databuilder.data_hash
+        self.envdata_cache = OrderedDict()
+        self.envdata_generation = 0
+        self.configfile_cache = {}
+        self.conffiles_cache = None
+
+        #
+        # Special updated configuration we use for firing events
+        #
+        self.event_data = bb.data.createCopy(self.data)
+        bb.data.update_data(self.event_data)
+        bb.parse.init_parser(self.event_data)
+
+        if CookerFeatures.BASEDATASTORE_TRACKING in self.featureset:
+            self.disableDataTracking()
+
+    def initCachesArray(self):
+        self.caches_array = []
+
         all_extra_cache_names = []
         # We hardcode all known cache types in a single place, here.
         if CookerFeatures.HOB_EXTRA_CACHES in self.featureset:
@@ -200,20 +367,19 @@ class BBCooker:
                 logger.critical("Unable to import extra RecipeInfo '%s' from '%s': %s" % (cache_name, module_name, exc))
                 sys.exit("FATAL: Failed to import extra cache class '%s'." % cache_name)
 
-        self.databuilder = bb.cookerdata.CookerDataBuilder(self.configuration, False)
-        self.databuilder.parseBaseConfiguration()
-        self.data = self.databuilder.data
-        self.data_hash = self.databuilder.data_hash
-
-        #
-        # Special updated configuration we use for firing events
-        #
-        self.event_data = bb.data.createCopy(self.data)
-        bb.data.update_data(self.event_data)
-        bb.parse.init_parser(self.event_data)
+        # if we have extra caches, list all attributes they bring in
+        self.extra_info_fields = []
+        for cache_class in self.caches_array:
+            if type(cache_class) is type and issubclass(cache_class, bb.cache.RecipeInfoCommon) and hasattr(cache_class, 'cachefields'):
+                self.extra_info_fields.extend(getattr(cache_class, 'cachefields', []))
 
-        if CookerFeatures.BASEDATASTORE_TRACKING in self.featureset:
-            self.disableDataTracking()
+    def clearEnvdataCache(self):
+        """
+        Forget the recipe datastores kept by loadDataFull(), they were
+        parsed against a self.data which has since changed
+        """
+        self.envdata_generation += 1
+        self.envdata_cache.clear()
 
     def enableDataTracking(self):
         self.configuration.tracking = True
@@ -236,7 +402,7 @@ class BBCooker:
 
     def appendConfigurationVar(self, var, val, default_file):
         #add append var operation to the end of default_file
-        default_file = bb.cookerdata.findConfigFile(default_file, self.data)
+        default_file = self.findConfigFile(default_file)
 
         total = "#added by hob"
         total += "\n%s += \"%s\"\n" % (var, val)
@@ -247,6 +413,7 @@ class BBCooker:
         #add to history
         loginfo = {"op":append, "file":default_file, "line":total.count("\n")}
         self.data.appendVar(var, val, **loginfo)
+        self.clearEnvdataCache()
 
     def saveConfigurationVar(self, var, val, default_file, op):
 
@@ -255,56 +422,32 @@ class BBCooker:
         if str(val) == self.data.getVar(var):
             return
 
-        conf_files = self.data.varhistory.get_variable_files(var)
-
         #format the value when it is a list
         if isinstance(val, list):
-            listval = ""
-            for value in val:
-                listval += "%s   " % value
-            val = listval
-
-        topdir = self.data.getVar("TOPDIR")
+            val = "".join("%s   " % value for value in val)
 
         #comment or replace operations made on var
-        for conf_file in conf_files:
-            if topdir in conf_file:
-                with open(conf_file, 'r') as f:
-                    contents = f.readlines()
-
-                lines = self.data.varhistory.get_variable_lines(var, conf_file)
-                for line in lines:
-                    total = ""
-                    i = 0
-                    for c in contents:
-                        total += c
-                        i = i + 1
-                        if i==int(line):
-                            end_index = len(total)
-                    index = total.rfind(var, 0, end_index)
-
-                    begin_line = total.count("\n",0,index)
-                    end_line = int(line)
-
-                    #check if the variable was saved before in the same way
-                    #if true it replace the place where the variable was declared
-                    #else it comments it
-                    if contents[begin_line-1]== "#added by hob\n":
-                        contents[begin_line] = "%s %s \"%s\"\n" % (var, op, val)
-                        replaced = True
-                    else:
-                        for ii in range(begin_line, end_line):
-                            contents[ii] = "#" + contents[ii]
+        for conf_file, contents, _, locations in self.findConfigurationVar(var):
+            for line, begin_line, end_line in locations:
+                #check if the variable was saved before in the same way
+                #if true it replace the place where the variable was declared
+                #else it comments it
+                if contents[begin_line-1]== "#added by hob\n":
+                    contents[begin_line] = "%s %s \"%s\"\n" % (var, op, val)
+                    replaced = True
+                else:
+                    for ii in range(begin_line, end_line):
+                        contents[ii] = "#" + contents[ii]
 
-                with open(conf_file, 'w') as f:
-                    f.writelines(contents)
+            with open(conf_file, 'w') as f:
+                f.writelines(contents)
 
         if replaced == False:
             #remove var from history
             self.data.varhistory.del_var_history(var)
 
             #add var to the end of default_file
-            default_file = bb.cookerdata.findConfigFile(default_file, self.data)
+            default_file = self.findConfigFile(default_file)
 
             #add the variable on a single line, to be easy to replace the second time
             total = "\n#added by hob"
@@ -316,46 +459,90 @@ class BBCooker:
             #add to history
             loginfo = {"op":set, "file":default_file, "line":total.count("\n")}
             self.data.setVar(var, val, **loginfo)
+            self.clearEnvdataCache()
 
     def removeConfigurationVar(self, var):
-        conf_files = self.data.varhistory.get_variable_files(var)
+        for conf_file, contents, offsets, locations in self.findConfigurationVar(var):
+            blank = set()
+            for line, begin_line, end_line in locations:
+                #check if the variable was saved before in the same way
+                if begin_line > 0 and contents[begin_line-1]== "#added by hob\n":
+                    blank.add(begin_line-1)
+                blank.add(begin_line)
+                #remove var from history
+                self.data.varhistory.del_var_history(var, conf_file, line)
+                #remove variable
+                self.data.delVar(var)
+                self.clearEnvdataCache()
+
+            # Blank the lines in place, padding with spaces so that none of
+            # the rest of the file has to be rewritten
+            with open(conf_file, 'r+b') as f:
+                for i in sorted(blank):
+                    length = len(contents[i].rstrip("\n"))
+                    f.seek(offsets[i])
+                    f.write(" " * length)
+
+    def findConfigurationVar(self, var):
+        """
+        Yield (conf_file, contents, offsets, locations) for each
+        configuration file under TOPDIR where var is set, with the lines of
+        the file read once. offsets[i] is the file position where line i
+        starts. locations lists (line, begin_line, end_line) for each
+        assignment, line being the line recorded in the variable history and
+        begin_line:end_line the slice of contents holding the assignment.
+        """
         topdir = self.data.getVar("TOPDIR")
 
-        for conf_file in conf_files:
-            if topdir in conf_file:
-                with open(conf_file, 'r') as f:
-                    contents = f.readlines()
-
-                lines = self.data.varhistory.get_variable_lines(var, conf_file)
-                for line in lines:
-                    total = ""
-                    i = 0
-                    for c in contents:
-                        total += c
-                        i = i + 1
-                        if i==int(line):
-                            end_index = len(total)
-                    index = total.rfind(var, 0, end_index)
-
-                    begin_line = total.count("\n",0,index)
-
-                    #check if the variable was saved before in the same way
-                    if contents[begin_line-1]== "#added by hob\n":
-                        contents[begin_line-1] = contents[begin_line] = "\n"
-                    else:
-                        contents[begin_line] = "\n"
-                    #remove var from history
-                    self.data.varhistory.del_var_history(var, conf_file, line)
-                    #remove variable
-                    self.data.delVar(var)
+        # Group the recorded lines by file in a single pass over the history
+        edits = OrderedDict()
+        for event in self.data.varhistory.variable(var):
+            conf_file = event['file']
+            if topdir not in conf_file:
+                continue
+            edits.setdefault(conf_file, []).append(event['line'])
+
+        for conf_file, lines in edits.iteritems():
+            with open(conf_file, 'r') as f:
+                contents = f.readlines()
 
-                with open(conf_file, 'w') as f:
-                    f.writelines(contents)
+            # offsets[i] is the position of the start of line i in total
+            total = "".join(contents)
+            offsets = [0]
+            for c in contents:
+                offsets.append(offsets[-1] + len(c))
+
+            locations = []
+            for line in lines:
+                end_index = offsets[int(line)]
+                index = total.rfind(var, 0, end_index)
+                begin_line = bisect.bisect_right(offsets, index) - 1
+                locations.append((line, begin_line, int(line)))
+
+            yield conf_file, contents, offsets, locations
+
+    def findConfigFile(self, configfile):
+        """
+        Cached wrapper around bb.cookerdata.findConfigFile(). The result
+        depends on BBPATH and the current directory so both are part of the
+        key, and a cached path is only used while it still exists.
+        """
+        key = (configfile, self.data.getVar("BBPATH", True), os.getcwd())
+        path = self.configfile_cache.get(key)
+        if path and os.path.exists(path):
+            return path
+
+        path = bb.cookerdata.findConfigFile(configfile, self.data)
+        if path:
+            self.configfile_cache[key] = path
+        return path
 
     def createConfigFile(self, name):
         path = os.getcwd()
         confpath = os.path.join(path, "conf", name)
         open(confpath, 'w').close()
+        # The new file may take precedence over one found earlier
+        self.configfile_cache.clear()
 
     def parseConfiguration(self):
         # Set log file verbosity
@@ -373,6 +560,7 @@ class BBCooker:
         if self.recipecache:
             del self.recipecache
         self.recipecache = bb.cache.CacheData(self.caches_array)
+        self.inherits_cache = {}
 
         self.handleCollections( self.data.getVar("BBFILE_COLLECTIONS", True) )
 
@@ -397,17 +585,21 @@ class BBCooker:
         logger.plain("%-35s %25s %25s", "Recipe Name", "Latest Version", "Preferred Version")
         logger.plain("%-35s %25s %25s\n", "===========", "==============", "=================")
 
+        rows = []
         for p in sorted(pkg_pn):
             pref = preferred_versions[p]
             latest = latest_versions[p]
 
-            prefstr = pref[0][0] + ":" + pref[0][1] + '-' + pref[0][2]
-            lateststr = latest[0][0] + ":" + latest[0][1] + "-" + latest[0][2]
+            prefstr = "%s:%s-%s" % pref[0]
+            lateststr = "%s:%s-%s" % latest[0]
 
             if pref == latest:
                 prefstr = ""
 
-            logger.plain("%-35s %25s %25s", p, lateststr, prefstr)
+            rows.append("%-35s %25s %25s" % (p, lateststr, prefstr))
+
+        if rows:
+            logger.plain("\n".join(rows))
 
     def showEnvironment(self, buildfile = None, pkgs_to_build = []):
         """
@@ -439,7 +631,7 @@ class BBCooker:
 
         if fn:
             try:
-                envdata = bb.cache.Cache.loadDataFull(fn, self.collection.get_file_appends(fn), self.data)
+                envdata = self.loadDataFull(fn, self.collection.get_file_appends(fn))
             except Exception as e:
                 parselog.exception("Unable to read %s", fn)
                 raise
@@ -451,9 +643,8 @@ class BBCooker:
 
         # emit variables and shell functions
         data.update_data(envdata)
-        with closing(StringIO()) as env:
+        with closing(LogWriter(logger)) as env:
             data.emit_env(env, envdata, True)
-            logger.plain(env.getvalue())
 
         # emit the metadata which isnt valid shell
         data.expandKeys(envdata)
@@ -462,10 +653,78 @@ class BBCooker:
                 logger.plain("\npython %s () {\n%s}\n", e, data.getVar(e, envdata, 1))
 
 
+    def loadDataFull(self, fn, appends):
+        """
+        Return a complete datastore for fn, reusing an earlier parse when
+        neither the recipe, its appends nor anything it included changed
+        """
+        def file_mtime(f):
+            try:
+                return os.stat(f)[stat.ST_MTIME]
+            except OSError:
+                return 0
+
+        key = (fn, tuple(appends), self.data_hash, self.envdata_generation)
+        cached = self.envdata_cache.get(key)
+        if cached:
+            depends, envdata = cached
+            if all(file_mtime(f) == mtime for (f, mtime) in depends):
+                return bb.data.createCopy(envdata)
+            self.envdata_cache.pop(key, None)
+
+        def parse():
+            realfn = bb.cache.Cache.virtualfn2realfn(fn)[0]
+            depends = [(f, file_mtime(f)) for f in [realfn] + list(appends)]
+            envdata = bb.cache.Cache.loadDataFull(fn, appends, self.data)
+            depends.extend(envdata.getVar("__depends", False) or [])
+
+            self.envdata_cache[key] = (depends, envdata)
+            while len(self.envdata_cache) > 4:
+                self.envdata_cache.popitem(last=False)
+            return envdata
+
+        envdata = self.singleFlight(("loadDataFull",) + key, parse)
+        return bb.data.createCopy(envdata)
+
+    def singleFlight(self, key, func, args=(), share=None):
+        """
+        Call func(*args), unless a call for the same key is already running
+        in another thread, in which case wait for it and return its result
+        (passed through share, if given) or raise its exception instead
+        """
+        with self.inprogress_lock:
+            flight = self.inprogress.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inprogress[key] = [threading.Event(), None, None]
+
+        if not leader:
+            flight[0].wait()
+            if flight[2]:
+                raise flight[2]
+            if share:
+                return share(flight[1])
+            return flight[1]
+
+        try:
+            flight[1] = func(*args)
+        except Exception as exc:
+            flight[2] = exc
+            raise
+        finally:
+            with self.inprogress_lock:
+                del self.inprogress[key]
+            flight[0].set()
+        return flight[1]
+
     def buildTaskData(self, pkgs_to_build, task, abort):
         """
         Prepare a runqueue and taskdata object for iteration over pkgs_to_build
         """
+        key = ("buildTaskData", tuple(pkgs_to_build), task, abort)
+        return self.singleFlight(key, self._buildTaskData, (pkgs_to_build, task, abort), copy.deepcopy)
+
+    def _buildTaskData(self, pkgs_to_build, task, abort):
         bb.event.fire(bb.event.TreeDataPreparationStarted(), self.data)
 
         # A task of None means use the default task
@@ -480,6 +739,9 @@ class BBCooker:
         taskdata = bb.taskdata.TaskData(abort, skiplist=self.skiplist)
 
         current = 0
+        total = len(fulltargetlist)
+        # Around a hundred progress updates are plenty for the UIs
+        progress_chunk = max(total // 100, 1)
         runlist = []
         for k in fulltargetlist:
             ktask = task
@@ -490,9 +752,10 @@ class BBCooker:
             taskdata.add_provider(localdata, self.recipecache, k)
             current += 1
             runlist.append([k, "do_%s" % ktask])
-            bb.event.fire(bb.event.TreeDataPreparationProgress(current, len(fulltargetlist)), self.data)
+            if current % progress_chunk == 0 or current == total:
+                bb.event.fire(bb.event.TreeDataPreparationProgress(current, total), self.data)
         taskdata.add_unresolved(localdata, self.recipecache)
-        bb.event.fire(bb.event.TreeDataPreparationCompleted(len(fulltargetlist)), self.data)
+        bb.event.fire(bb.event.TreeDataPreparationCompleted(total), self.data)
         return taskdata, runlist, fulltargetlist
 
     def prepareTreeData(self, pkgs_to_build, task):
@@ -520,10 +783,10 @@ class BBCooker:
 
 
     def buildDependTree(self, rq, taskdata):
-        seen_fnids = []
+        seen_fnids = set()
         depend_tree = {}
         depend_tree["depends"] = {}
-        depend_tree["tdepends"] = {}
+        depend_tree["tdepends"] = defaultdict(list)
         depend_tree["pn"] = {}
         depend_tree["rdepends-pn"] = {}
         depend_tree["packages"] = {}
@@ -531,71 +794,70 @@ class BBCooker:
         depend_tree["rrecs-pkg"] = {}
         depend_tree["layer-priorities"] = self.recipecache.bbfile_config_priorities
 
-        for task in xrange(len(rq.rqdata.runq_fnid)):
-            taskname = rq.rqdata.runq_task[task]
-            fnid = rq.rqdata.runq_fnid[task]
-            fn = taskdata.fn_index[fnid]
-            pn = self.recipecache.pkg_fn[fn]
-            version  = "%s:%s-%s" % self.recipecache.pkg_pepvpr[fn]
-            if pn not in depend_tree["pn"]:
-                depend_tree["pn"][pn] = {}
-                depend_tree["pn"][pn]["filename"] = fn
-                depend_tree["pn"][pn]["version"] = version
-                depend_tree["pn"][pn]["inherits"] = self.recipecache.inherits.get(fn, None)
-
-                # if we have extra caches, list all attributes they bring in
-                extra_info = []
-                for cache_class in self.caches_array:
-                    if type(cache_class) is type and issubclass(cache_class, bb.cache.RecipeInfoCommon) and hasattr(cache_class, 'cachefields'):
-                        cachefields = getattr(cache_class, 'cachefields', [])
-                        extra_info = extra_info + cachefields
+        extra_info = [(ei, getattr(self.recipecache, ei)) for ei in self.extra_info_fields]
+
+        runq_fnid = rq.rqdata.runq_fnid
+        runq_task = rq.rqdata.runq_task
+        runq_depends = rq.rqdata.runq_depends
+        fn_index = taskdata.fn_index
+        depids = taskdata.depids
+        rdepids = taskdata.rdepids
+        build_names_index = taskdata.build_names_index
+        run_names_index = taskdata.run_names_index
+        pkg_fn = self.recipecache.pkg_fn
+        pkg_pepvpr = self.recipecache.pkg_pepvpr
+        inherits = self.recipecache.inherits
+        rundeps = self.recipecache.rundeps
+        runrecs = self.recipecache.runrecs
+
+        pn_tree = depend_tree["pn"]
+        tdepends_tree = depend_tree["tdepends"]
+        depends_tree = depend_tree["depends"]
+        rdepends_pn_tree = depend_tree["rdepends-pn"]
+        rdepends_pkg_tree = depend_tree["rdepends-pkg"]
+        rrecs_pkg_tree = depend_tree["rrecs-pkg"]
+        packages_tree = depend_tree["packages"]
+
+        for task, fnid in enumerate(runq_fnid):
+            taskname = runq_task[task]
+            fn = fn_index[fnid]
+            pn = pkg_fn[fn]
+            version  = "%s:%s-%s" % pkg_pepvpr[fn]
+            if pn not in pn_tree:
+                pn_info = pn_tree[pn] = {"filename" : fn, "version" : version,
+                                         "inherits" : inherits.get(fn, None)}
 
                 # for all attributes stored, add them to the dependency tree
-                for ei in extra_info:
-                    depend_tree["pn"][pn][ei] = vars(self.recipecache)[ei][fn]
+                pn_info.update([(ei, eidata[fn]) for ei, eidata in extra_info])
 
 
-            for dep in rq.rqdata.runq_depends[task]:
-                depfn = taskdata.fn_index[rq.rqdata.runq_fnid[dep]]
-                deppn = self.recipecache.pkg_fn[depfn]
-                dotname = "%s.%s" % (pn, rq.rqdata.runq_task[task])
-                if not dotname in depend_tree["tdepends"]:
-                    depend_tree["tdepends"][dotname] = []
-                depend_tree["tdepends"][dotname].append("%s.%s" % (deppn, rq.rqdata.runq_task[dep]))
+            taskdeps = runq_depends[task]
+            if taskdeps:
+                dotname = "%s.%s" % (pn, taskname)
+                tdepends_tree[dotname].extend(["%s.%s" % (pkg_fn[fn_index[runq_fnid[dep]]], runq_task[dep])
+                                               for dep in taskdeps])
             if fnid not in seen_fnids:
-                seen_fnids.append(fnid)
-                packages = []
+                seen_fnids.add(fnid)
 
-                depend_tree["depends"][pn] = []
-                for dep in taskdata.depids[fnid]:
-                    depend_tree["depends"][pn].append(taskdata.build_names_index[dep])
+                depends_tree[pn] = [build_names_index[dep] for dep in depids[fnid]]
+                rdepends_pn_tree[pn] = [run_names_index[rdep] for rdep in rdepids[fnid]]
 
-                depend_tree["rdepends-pn"][pn] = []
-                for rdep in taskdata.rdepids[fnid]:
-                    depend_tree["rdepends-pn"][pn].append(taskdata.run_names_index[rdep])
-
-                rdepends = self.recipecache.rundeps[fn]
+                rdepends = rundeps[fn]
+                packages = list(rdepends)
                 for package in rdepends:
-                    depend_tree["rdepends-pkg"][package] = []
-                    for rdepend in rdepends[package]:
-                        depend_tree["rdepends-pkg"][package].append(rdepend)
-                    packages.append(package)
+                    rdepends_pkg_tree[package] = list(rdepends[package])
 
-                rrecs = self.recipecache.runrecs[fn]
+                rrecs = runrecs[fn]
                 for package in rrecs:
-                    depend_tree["rrecs-pkg"][package] = []
-                    for rdepend in rrecs[package]:
-                        depend_tree["rrecs-pkg"][package].append(rdepend)
+                    rrecs_pkg_tree[package] = list(rrecs[package])
                     if not package in packages:
                         packages.append(package)
 
                 for package in packages:
-                    if package not in depend_tree["packages"]:
-                        depend_tree["packages"][package] = {}
-                        depend_tree["packages"][package]["pn"] = pn
-                        depend_tree["packages"][package]["filename"] = fn
-                        depend_tree["packages"][package]["version"] = version
+                    if package not in packages_tree:
+                        packages_tree[package] = {"pn" : pn, "filename" : fn, "version" : version}
 
+        depend_tree["tdepends"] = dict(depend_tree["tdepends"])
         return depend_tree
 
     ######## WARNING : this function requires cache_extra to be enabled ########
@@ -604,12 +866,8 @@ class BBCooker:
         Create a dependency tree of pkgs_to_build, returning the data.
         """
         _, taskdata = self.prepareTreeData(pkgs_to_build, task)
-        tasks_fnid = []
-        if len(taskdata.tasks_name) != 0:
-            for task in xrange(len(taskdata.tasks_name)):
-                tasks_fnid.append(taskdata.tasks_fnid[task])
 
-        seen_fnids = []
+        seen_fnids = set()
         depend_tree = {}
         depend_tree["depends"] = {}
         depend_tree["pn"] = {}
@@ -617,59 +875,52 @@ class BBCooker:
         depend_tree["rdepends-pkg"] = {}
         depend_tree["rrecs-pkg"] = {}
 
-        # if we have extra caches, list all attributes they bring in
-        extra_info = []
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, bb.cache.RecipeInfoCommon) and hasattr(cache_class, 'cachefields'):
-                cachefields = getattr(cache_class, 'cachefields', [])
-                extra_info = extra_info + cachefields
-
-        for task in xrange(len(tasks_fnid)):
-            fnid = tasks_fnid[task]
-            fn = taskdata.fn_index[fnid]
-            pn = self.recipecache.pkg_fn[fn]
-
-            if pn not in depend_tree["pn"]:
-                depend_tree["pn"][pn] = {}
-                depend_tree["pn"][pn]["filename"] = fn
-                version  = "%s:%s-%s" % self.recipecache.pkg_pepvpr[fn]
-                depend_tree["pn"][pn]["version"] = version
-                rdepends = self.recipecache.rundeps[fn]
-                rrecs = self.recipecache.runrecs[fn]
-                depend_tree["pn"][pn]["inherits"] = self.recipecache.inherits.get(fn, None)
+        extra_info = [(ei, getattr(self.recipecache, ei)) for ei in self.extra_info_fields]
+
+        fn_index = taskdata.fn_index
+        depids = taskdata.depids
+        rdepids = taskdata.rdepids
+        build_names_index = taskdata.build_names_index
+        run_names_index = taskdata.run_names_index
+        build_targets = taskdata.build_targets
+        run_targets = taskdata.run_targets
+        pkg_fn = self.recipecache.pkg_fn
+        pkg_pepvpr = self.recipecache.pkg_pepvpr
+        inherits = self.recipecache.inherits
+        rundeps = self.recipecache.rundeps
+        runrecs = self.recipecache.runrecs
+
+        pn_tree = depend_tree["pn"]
+        depends_tree = depend_tree["depends"]
+        rdepends_pn_tree = depend_tree["rdepends-pn"]
+
+        def provider_pn(item, targetid, targets):
+            if targetid in targets and targets[targetid]:
+                return pkg_fn[fn_index[targets[targetid][0]]]
+            return item
+
+        for fnid in taskdata.tasks_fnid:
+            fn = fn_index[fnid]
+            pn = pkg_fn[fn]
+
+            if pn not in pn_tree:
+                version  = "%s:%s-%s" % pkg_pepvpr[fn]
+                rdepends = rundeps[fn]
+                rrecs = runrecs[fn]
+                pn_info = pn_tree[pn] = {"filename" : fn, "version" : version,
+                                         "inherits" : inherits.get(fn, None)}
 
                 # for all extra attributes stored, add them to the dependency tree
-                for ei in extra_info:
-                    depend_tree["pn"][pn][ei] = vars(self.recipecache)[ei][fn]
+                pn_info.update([(ei, eidata[fn]) for ei, eidata in extra_info])
 
             if fnid not in seen_fnids:
-                seen_fnids.append(fnid)
-
-                depend_tree["depends"][pn] = []
-                for dep in taskdata.depids[fnid]:
-                    item = taskdata.build_names_index[dep]
-                    pn_provider = ""
-                    targetid = taskdata.getbuild_id(item)
-                    if targetid in taskdata.build_targets and taskdata.build_targets[targetid]:
-                        id = taskdata.build_targets[targetid][0]
-                        fn_provider = taskdata.fn_index[id]
-                        pn_provider = self.recipecache.pkg_fn[fn_provider]
-                    else:
-                        pn_provider = item
-                    depend_tree["depends"][pn].append(pn_provider)
-
-                depend_tree["rdepends-pn"][pn] = []
-                for rdep in taskdata.rdepids[fnid]:
-                    item = taskdata.run_names_index[rdep]
-                    pn_rprovider = ""
-                    targetid = taskdata.getrun_id(item)
-                    if targetid in taskdata.run_targets and taskdata.run_targets[targetid]:
-                        id = taskdata.run_targets[targetid][0]
-                        fn_rprovider = taskdata.fn_index[id]
-                        pn_rprovider = self.recipecache.pkg_fn[fn_rprovider]
-                    else:
-                        pn_rprovider = item
-                    depend_tree["rdepends-pn"][pn].append(pn_rprovider)
+                seen_fnids.add(fnid)
+
+                # build/run target ids are indices into the names lists
+                depends_tree[pn] = [provider_pn(build_names_index[dep], dep, build_targets)
+                                    for dep in depids[fnid]]
+                rdepends_pn_tree[pn] = [provider_pn(run_names_index[rdep], rdep, run_targets)
+                                        for rdep in rdepids[fnid]]
 
                 depend_tree["rdepends-pkg"].update(rdepends)
                 depend_tree["rrecs-pkg"].update(rrecs)
@@ -693,62 +944,67 @@ class BBCooker:
         depgraph = self.generateTaskDepTreeData(pkgs_to_build, task)
 
         # Prints a flattened form of package-depends below where subpackages of a package are merged into the main pn
-        depends_file = file('pn-depends.dot', 'w' )
-        buildlist_file = file('pn-buildlist', 'w' )
-        print("digraph depends {", file=depends_file)
+        lines = ["digraph depends {"]
+        buildlist = []
         for pn in depgraph["pn"]:
             fn = depgraph["pn"][pn]["filename"]
             version = depgraph["pn"][pn]["version"]
-            print('"%s" [label="%s %s\\n%s"]' % (pn, pn, version, fn), file=depends_file)
-            print("%s" % pn, file=buildlist_file)
-        buildlist_file.close()
+            lines.append('"%s" [label="%s %s\\n%s"]' % (pn, pn, version, fn))
+            buildlist.append("%s\n" % pn)
+        with open('pn-buildlist', 'w') as f:
+            f.writelines(buildlist)
         logger.info("PN build list saved to 'pn-buildlist'")
         for pn in depgraph["depends"]:
             for depend in depgraph["depends"][pn]:
-                print('"%s" -> "%s"' % (pn, depend), file=depends_file)
+                lines.append('"%s" -> "%s"' % (pn, depend))
         for pn in depgraph["rdepends-pn"]:
             for rdepend in depgraph["rdepends-pn"][pn]:
-                print('"%s" -> "%s" [style=dashed]' % (pn, rdepend), file=depends_file)
-        print("}", file=depends_file)
+                lines.append('"%s" -> "%s" [style=dashed]' % (pn, rdepend))
+        lines.append("}")
+        with open('pn-depends.dot', 'w') as f:
+            f.write("\n".join(lines) + "\n")
         logger.info("PN dependencies saved to 'pn-depends.dot'")
 
-        depends_file = file('package-depends.dot', 'w' )
-        print("digraph depends {", file=depends_file)
+        lines = ["digraph depends {"]
         for package in depgraph["packages"]:
             pn = depgraph["packages"][package]["pn"]
             fn = depgraph["packages"][package]["filename"]
             version = depgraph["packages"][package]["version"]
             if package == pn:
-                print('"%s" [label="%s %s\\n%s"]' % (pn, pn, version, fn), file=depends_file)
+                lines.append('"%s" [label="%s %s\\n%s"]' % (pn, pn, version, fn))
             else:
-                print('"%s" [label="%s(%s) %s\\n%s"]' % (package, package, pn, version, fn), file=depends_file)
+                lines.append('"%s" [label="%s(%s) %s\\n%s"]' % (package, package, pn, version, fn))
             for depend in depgraph["depends"][pn]:
-                print('"%s" -> "%s"' % (package, depend), file=depends_file)
+                lines.append('"%s" -> "%s"' % (package, depend))
         for package in depgraph["rdepends-pkg"]:
             for rdepend in depgraph["rdepends-pkg"][package]:
-                print('"%s" -> "%s" [style=dashed]' % (package, rdepend), file=depends_file)
+                lines.append('"%s" -> "%s" [style=dashed]' % (package, rdepend))
         for package in depgraph["rrecs-pkg"]:
             for rdepend in depgraph["rrecs-pkg"][package]:
-                print('"%s" -> "%s" [style=dashed]' % (package, rdepend), file=depends_file)
-        print("}", file=depends_file)
+                lines.append('"%s" -> "%s" [style=dashed]' % (package, rdepend))
+        lines.append("}")
+        with open('package-depends.dot', 'w') as f:
+            f.write("\n".join(lines) + "\n")
         logger.info("Package dependencies saved to 'package-depends.dot'")
 
-        tdepends_file = file('task-depends.dot', 'w' )
-        print("digraph depends {", file=tdepends_file)
+        lines = ["digraph depends {"]
         for task in depgraph["tdepends"]:
             (pn, taskname) = task.rsplit(".", 1)
             fn = depgraph["pn"][pn]["filename"]
             version = depgraph["pn"][pn]["version"]
-            print('"%s.%s" [label="%s %s\\n%s\\n%s"]' % (pn, taskname, pn, taskname, version, fn), file=tdepends_file)
+            lines.append('"%s.%s" [label="%s %s\\n%s\\n%s"]' % (pn, taskname, pn, taskname, version, fn))
             for dep in depgraph["tdepends"][task]:
-                print('"%s" -> "%s"' % (task, dep), file=tdepends_file)
-        print("}", file=tdepends_file)
+                lines.append('"%s" -> "%s"' % (task, dep))
+        lines.append("}")
+        with open('task-depends.dot', 'w') as f:
+            f.write("\n".join(lines) + "\n")
         logger.info("Task dependencies saved to 'task-depends.dot'")
 
     def show_appends_with_no_recipes( self ):
+        applied = self.collection.get_applied_appends()
         appends_without_recipes = [self.collection.appendlist[recipe]
                                    for recipe in self.collection.appendlist
-                                   if recipe not in self.collection.appliedappendlist]
+                                   if recipe not in applied]
         if appends_without_recipes:
             appendlines = ('  %s' % append
                            for appends in appends_without_recipes
@@ -763,6 +1019,19 @@ class BBCooker:
 
     def handlePrefProviders(self):
 
+        # Copying and finalising the whole datastore is expensive and in most
+        # configurations PREFERRED_PROVIDERS isn't set at all. Only go on if
+        # some variable is or could expand to PREFERRED_PROVIDERS or one of
+        # its overrides.
+        for key in self.data.keys():
+            prefix = key.split('${', 1)[0]
+            if prefix.startswith('PREFERRED_PROVIDERS'):
+                break
+            if prefix != key and 'PREFERRED_PROVIDERS'.startswith(prefix):
+                break
+        else:
+            return
+
         localdata = data.createCopy(self.data)
         bb.data.update_data(localdata)
         bb.data.expandKeys(localdata)
@@ -781,11 +1050,12 @@ class BBCooker:
     def findCoreBaseFiles(self, subdir, configfile):
         corebase = self.data.getVar('COREBASE', True) or ""
         paths = []
-        for root, dirs, files in os.walk(corebase + '/' + subdir):
+        for root, dirs, files in walk(corebase + '/' + subdir):
+            prefix = os.path.join(root, "")
             for d in dirs:
-                configfilepath = os.path.join(root, d, configfile)
-                if os.path.exists(configfilepath):
-                    paths.append(os.path.join(root, d))
+                dirpath = prefix + d
+                if os.path.exists(os.path.join(dirpath, configfile)):
+                    paths.append(dirpath)
 
         if paths:
             bb.event.fire(bb.event.CoreBaseFilesFound(paths), self.data)
@@ -795,29 +1065,28 @@ class BBCooker:
         Find the location on disk of configfile and if it exists and was parsed by BitBake
         emit the ConfigFilePathFound event with the path to the file.
         """
-        path = bb.cookerdata.findConfigFile(configfile, self.data)
+        path = self.findConfigFile(configfile)
         if not path:
             return
 
-        # Generate a list of parsed configuration files by searching the files
-        # listed in the __depends and __base_depends variables with a .conf suffix.
-        conffiles = []
-        dep_files = self.data.getVar('__base_depends') or []
-        dep_files = dep_files + (self.data.getVar('__depends') or [])
-
-        for f in dep_files:
-            if f[0].endswith(".conf"):
-                conffiles.append(f[0])
-
         _, conf, conffile = path.rpartition("conf/")
         match = os.path.join(conf, conffile)
         # Try and find matches for conf/conffilename.conf as we don't always
         # have the full path to the file.
-        for cfg in conffiles:
-            if cfg.endswith(match):
-                bb.event.fire(bb.event.ConfigFilePathFound(path),
-                              self.data)
-                break
+        if any(cfg.endswith(match) for cfg in self.parsedConfFiles()):
+            bb.event.fire(bb.event.ConfigFilePathFound(path),
+                          self.data)
+
+    def parsedConfFiles(self):
+        """
+        Return the parsed configuration files, those listed in the __depends
+        and __base_depends variables with a .conf suffix.
+        """
+        if self.conffiles_cache is None:
+            dep_files = itertools.chain(self.data.getVar('__base_depends') or [],
+                                        self.data.getVar('__depends') or [])
+            self.conffiles_cache = tuple(f[0] for f in dep_files if f[0].endswith(".conf"))
+        return self.conffiles_cache
 
     def findFilesMatchingInDir(self, filepattern, directory):
         """
@@ -829,12 +1098,12 @@ class BBCooker:
         """
 
         matches = []
-        p = re.compile(re.escape(filepattern))
+        p = compile_regex(re.escape(filepattern))
         bbpaths = self.data.getVar('BBPATH', True).split(':')
         for path in bbpaths:
             dirpath = os.path.join(path, directory)
             if os.path.exists(dirpath):
-                for root, dirs, files in os.walk(dirpath):
+                for root, dirs, files in walk(dirpath):
                     for f in files:
                         if p.search(f):
                             matches.append(f)
@@ -842,10 +1111,11 @@ class BBCooker:
         if matches:
             bb.event.fire(bb.event.FilesMatchingFound(filepattern, matches), self.data)
 
-    def findConfigFiles(self, varname):
+    def findConfigFiles(self, varname, coalesce=False):
         """
         Find config files which are appropriate values for varname.
         i.e. MACHINE, DISTRO
+        If coalesce is set the result is held back until flushConfigFileEvents()
         """
         possible = []
         var = varname.lower()
@@ -856,28 +1126,41 @@ class BBCooker:
         for path in bbpaths:
             confpath = os.path.join(path, "conf", var)
             if os.path.exists(confpath):
-                for root, dirs, files in os.walk(confpath):
+                for root, dirs, files in walk(confpath):
                     # get all child files, these are appropriate values
-                    for f in files:
-                        val, sep, end = f.rpartition('.')
-                        if end == 'conf':
-                            possible.append(val)
+                    possible.extend(f[:-5] for f in files if f.endswith('.conf'))
 
         if possible:
-            bb.event.fire(bb.event.ConfigFilesFound(var, possible), self.data)
+            if coalesce:
+                self.pending_config_events.append((var, possible))
+            else:
+                bb.event.fire(bb.event.ConfigFilesFound(var, possible), self.data)
+
+    def flushConfigFileEvents(self):
+        """
+        Fire a single event with the findConfigFiles results held back so far
+        """
+        if self.pending_config_events:
+            entries = self.pending_config_events
+            self.pending_config_events = []
+            bb.event.fire(bb.event.ConfigFilesFoundBatch(entries), self.data)
 
     def findInheritsClass(self, klass):
         """
         Find all recipes which inherit the specified class
         """
+        if klass in self.inherits_cache:
+            return self.inherits_cache[klass][:]
+
         pkg_list = []
 
         for pfn in self.recipecache.pkg_fn:
             inherits = self.recipecache.inherits.get(pfn, None)
-            if inherits and inherits.count(klass) > 0:
+            if inherits and klass in inherits:
                 pkg_list.append(self.recipecache.pkg_fn[pfn])
 
-        return pkg_list
+        self.inherits_cache[klass] = pkg_list
+        return pkg_list[:]
 
     def generateTargetsTree(self, klass=None, pkgs=[]):
         """
@@ -902,20 +1185,34 @@ class BBCooker:
          Build package list for "bitbake world"
         """
         parselog.debug(1, "collating packages for \"world\"")
+        pkg_fn = self.recipecache.pkg_fn
+        pn_provides = self.recipecache.pn_provides
+        providers = self.recipecache.providers
+
+        # Whether a recipe can be a world target only depends on its PN, so
+        # work it out once per PN rather than once per recipe file
+        terminal_pn = {}
         for f in self.recipecache.possible_world:
-            terminal = True
-            pn = self.recipecache.pkg_fn[f]
+            pn = pkg_fn[f]
+            if pn in terminal_pn:
+                if terminal_pn[pn]:
+                    self.recipecache.world_target.add(pn)
+                continue
 
-            for p in self.recipecache.pn_provides[pn]:
+            terminal = True
+            for p in pn_provides[pn]:
                 if p.startswith('virtual/'):
                     parselog.debug(2, "World build skipping %s due to %s provider starting with virtual/", f, p)
                     terminal = False
                     break
-                for pf in self.recipecache.providers[p]:
-                    if self.recipecache.pkg_fn[pf] != pn:
+                for pf in providers[p]:
+                    if pkg_fn[pf] != pn:
                         parselog.debug(2, "World build skipping %s due to both us and %s providing %s", f, pf, p)
                         terminal = False
                         break
+                if not terminal:
+                    break
+            terminal_pn[pn] = terminal
             if terminal:
                 self.recipecache.world_target.add(pn)
 
@@ -938,6 +1235,8 @@ class BBCooker:
             collection_priorities = {}
             collection_depends = {}
             collection_list = collections.split()
+            collection_set = set(collection_list)
+            layerversions = {}
             min_prio = 0
             for c in collection_list:
                 # Get collection priority if defined explicitly
@@ -973,9 +1272,11 @@ class BBCooker:
                         dep = depsplit[0]
                         depnamelist.append(dep)
 
-                        if dep in collection_list:
+                        if dep in collection_set:
                             if depver:
-                                layerver = self.data.getVar("LAYERVERSION_%s" % dep, True)
+                                if dep not in layerversions:
+                                    layerversions[dep] = self.data.getVar("LAYERVERSION_%s" % dep, True)
+                                layerver = layerversions[dep]
                                 if layerver:
                                     try:
                                         lver = int(layerver)
@@ -996,29 +1297,54 @@ class BBCooker:
                 else:
                     collection_depends[c] = []
 
-            # Recursively work out collection priorities based on dependencies
+            # Work out collection priorities based on dependencies, each layer
+            # without an explicit priority is visited once, after the layers
+            # it depends on
+            calculated = set()
             def calc_layer_priority(collection):
-                if not collection_priorities[collection]:
-                    max_depprio = min_prio
-                    for dep in collection_depends[collection]:
-                        calc_layer_priority(dep)
-                        depprio = collection_priorities[dep]
-                        if depprio > max_depprio:
-                            max_depprio = depprio
-                    max_depprio += 1
-                    parselog.debug(1, "Calculated priority of layer %s as %d", collection, max_depprio)
-                    collection_priorities[collection] = max_depprio
+                if collection in calculated or collection_priorities[collection]:
+                    return True
+                valid = True
+                stack = [(collection, iter(collection_depends[collection]))]
+                visiting = set([collection])
+                while stack:
+                    current, deps = stack[-1]
+                    for dep in deps:
+                        if dep in calculated or dep not in collection_depends or collection_priorities[dep]:
+                            continue
+                        if dep in visiting:
+                            parselog.error("Layer '%s' depends on layer '%s', which in turn depends on it", current, dep)
+                            valid = False
+                            continue
+                        stack.append((dep, iter(collection_depends[dep])))
+                        visiting.add(dep)
+                        break
+                    else:
+                        stack.pop()
+                        visiting.remove(current)
+                        calculated.add(current)
+                        if not collection_priorities[current]:
+                            max_depprio = min_prio
+                            for dep in collection_depends[current]:
+                                depprio = collection_priorities.get(dep)
+                                if depprio > max_depprio:
+                                    max_depprio = depprio
+                            max_depprio += 1
+                            parselog.debug(1, "Calculated priority of layer %s as %d", current, max_depprio)
+                            collection_priorities[current] = max_depprio
+                return valid
 
             # Calculate all layer priorities using calc_layer_priority and store in bbfile_config_priorities
             for c in collection_list:
-                calc_layer_priority(c)
+                if not calc_layer_priority(c):
+                    errors = True
                 regex = self.data.getVar("BBFILE_PATTERN_%s" % c, True)
                 if regex == None:
                     parselog.error("BBFILE_PATTERN_%s not defined" % c)
                     errors = True
                     continue
                 try:
-                    cre = re.compile(regex)
+                    cre = compile_regex(regex)
                 except re.error:
                     parselog.error("BBFILE_PATTERN_%s \"%s\" is not a valid regular expression", c, regex)
                     errors = True
@@ -1030,11 +1356,16 @@ class BBCooker:
 
     def buildSetVars(self):
         """
-        Setup any variables needed before starting a build
+        Setup any variables needed before starting a build, returns BUILDNAME
         """
-        if not self.data.getVar("BUILDNAME"):
-            self.data.setVar("BUILDNAME", time.strftime('%Y%m%d%H%M'))
-        self.data.setVar("BUILDSTART", time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime()))
+        now = time.time()
+        buildname = self.data.getVar("BUILDNAME")
+        if not buildname:
+            buildname = time.strftime('%Y%m%d%H%M', time.localtime(now))
+            self.data.setVar("BUILDNAME", buildname)
+        self.data.setVar("BUILDSTART", time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime(now)))
+        self.clearEnvdataCache()
+        return buildname
 
     def matchFiles(self, bf):
         """
@@ -1095,7 +1426,7 @@ class BBCooker:
         fn, cls = bb.cache.Cache.virtualfn2realfn(buildfile)
         fn = self.matchFile(fn)
 
-        self.buildSetVars()
+        buildname = self.buildSetVars()
 
         infos = bb.cache.Cache.parse(fn, self.collection.get_file_appends(fn), \
                                      self.data,
@@ -1133,7 +1464,6 @@ class BBCooker:
         taskdata = bb.taskdata.TaskData(self.configuration.abort)
         taskdata.add_provider(self.data, self.recipecache, item)
 
-        buildname = self.data.getVar("BUILDNAME")
         bb.event.fire(bb.event.BuildStarted(buildname, [item]), self.event_data)
 
         # Execute the runqueue
@@ -1201,11 +1531,10 @@ class BBCooker:
                 return True
             return retval
 
-        self.buildSetVars()
+        buildname = self.buildSetVars()
 
         taskdata, runlist, fulltargetlist = self.buildTaskData(targets, task, self.configuration.abort)
 
-        buildname = self.data.getVar("BUILDNAME")
         bb.event.fire(bb.event.BuildStarted(buildname, fulltargetlist), self.data)
 
         rq = bb.runqueue.RunQueue(self, self.data, self.recipecache, taskdata, runlist)
@@ -1217,16 +1546,23 @@ class BBCooker:
 
     def getAllKeysWithFlags(self, flaglist):
         dump = {}
+        getVar = self.data.getVar
+        getVarFlag = self.data.getVarFlag
+        history = self.data.varhistory.variable
+        DataSmart = bb.data_smart.DataSmart
         for k in self.data.keys():
+            if k.startswith("__"):
+                continue
             try:
-                v = self.data.getVar(k, True)
-                if not k.startswith("__") and not isinstance(v, bb.data_smart.DataSmart):
-                    dump[k] = {
+                v = getVar(k, True)
+                if not isinstance(v, DataSmart):
+                    entry = {
     'v' : v ,
-    'history' : self.data.varhistory.variable(k),
+    'history' : history(k),
                     }
                     for d in flaglist:
-                        dump[k][d] = self.data.getVarFlag(k, d)
+                        entry[d] = getVarFlag(k, d)
+                    dump[k] = entry
             except Exception as e:
                 print(e)
         return dump
@@ -1250,10 +1586,8 @@ class BBCooker:
         if base_image:
             with open(base_image, 'r') as f:
                 require_line = f.readline()
-                p = re.compile("IMAGE_BASENAME *=")
-                for line in f:
-                    if p.search(line):
-                        basename = True
+                if image_basename_re.search(f.read()):
+                    basename = True
 
         with open(dest, "w") as imagefile:
             if base_image is None:
@@ -1306,21 +1640,29 @@ class BBCooker:
             (filelist, masked) = self.collection.collect_bbfiles(self.data, self.event_data)
 
             self.data.renameVar("__depends", "__base_depends")
+            self.conffiles_cache = None
 
             self.parser = CookerParser(self, filelist, masked)
+            self.inherits_cache = {}
             self.state = state.parsing
 
-        if not self.parser.parse_next():
-            collectlog.debug(1, "parsing complete")
-            if self.parser.error:
-                raise bb.BBHandledException()
-            self.show_appends_with_no_recipes()
-            self.handlePrefProviders()
-            self.recipecache.bbfile_priority = self.collection.collection_priorities(self.recipecache.pkg_fn)
-            self.state = state.running
-            return None
+        # Handle recipes for a short while rather than one per call, each
+        # call is a trip around the server loop. Commands are still checked
+        # for in between.
+        deadline = time.time() + 0.05
+        parse_next = self.parser.parse_next
+        while parse_next():
+            if time.time() >= deadline:
+                return True
 
-        return True
+        collectlog.debug(1, "parsing complete")
+        if self.parser.error:
+            raise bb.BBHandledException()
+        self.show_appends_with_no_recipes()
+        self.handlePrefProviders()
+        self.recipecache.bbfile_priority = self.collection.collection_priorities(self.recipecache.pkg_fn)
+        self.state = state.running
+        return None
 
     def checkPackages(self, pkgs_to_build):
 
@@ -1413,19 +1755,80 @@ class CookerExit(bb.event.Event):
 
 
 class CookerCollectFiles(object):
+    # Constructs which would change meaning once a pattern is embedded in a
+    # larger expression: backreferences, conditionals and global flags
+    unsafe_pattern = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[iLmsux]+\)')
+    max_pattern_groups = 100
+
+    FILELIST_CACHE_VERSION = "1"
+
     def __init__(self, priorities):
         self.appendlist = {}
-        self.appliedappendlist = []
+        self.append_index = None
+        self.file_appends = {}
         self.bbfile_config_priorities = priorities
+        self.priority_cache = {}
+
+        # Match runs of layer patterns in one go where possible. Alternatives
+        # are tried in order so the first matching layer still wins, patterns
+        # which can't be combined are matched on their own in between.
+        self.priority_matchers = []
+        run = []
+        for i, (_, pattern, cre, _) in enumerate(priorities):
+            if self.unsafe_pattern.search(pattern):
+                self.add_priority_matchers(run)
+                run = []
+                self.priority_matchers.append((cre, i))
+            else:
+                run.append(i)
+        self.add_priority_matchers(run)
+
+    def add_priority_matchers(self, run):
+        # Python 2's re can't compile an expression with more than 100
+        # groups, split the run so each part stays under that including the
+        # groups of the patterns themselves
+        chunk = []
+        groups = 0
+        for i in run:
+            needed = self.bbfile_config_priorities[i][2].groups + 1
+            if chunk and groups + needed > self.max_pattern_groups:
+                self.add_combined_matcher(chunk)
+                chunk = []
+                groups = 0
+            chunk.append(i)
+            groups += needed
+        self.add_combined_matcher(chunk)
+
+    def add_combined_matcher(self, run):
+        if len(run) > 1:
+            try:
+                combined = re.compile("|".join("(?P<bbfile_priority_%d>%s)" % (i, self.bbfile_config_priorities[i][1])
+                                               for i in run))
+            except (re.error, AssertionError, OverflowError):
+                pass
+            else:
+                self.priority_matchers.append((combined, None))
+                return
+        for i in run:
+            self.priority_matchers.append((self.bbfile_config_priorities[i][2], i))
 
     def calc_bbfile_priority( self, filename, matched = None ):
-        for _, _, regex, pri in self.bbfile_config_priorities:
-            if regex.match(filename):
-                if matched != None:
-                    if not regex in matched:
-                        matched.add(regex)
-                return pri
-        return 0
+        if filename in self.priority_cache:
+            regex, pri = self.priority_cache[filename]
+        else:
+            regex, pri = None, 0
+            for cre, index in self.priority_matchers:
+                m = cre.match(filename)
+                if m:
+                    if index is None:
+                        index = int(m.lastgroup.rsplit("_", 1)[1])
+                    _, _, regex, pri = self.bbfile_config_priorities[index]
+                    break
+            self.priority_cache[filename] = (regex, pri)
+
+        if regex and matched != None:
+            matched.add(regex)
+        return pri
 
     def get_bbfiles(self):
         """Get list of default .bb files by reading out the current directory"""
@@ -1437,17 +1840,120 @@ class CookerCollectFiles(object):
                 bbfiles.append(os.path.abspath(os.path.join(path, f)))
         return bbfiles
 
-    def find_bbfiles(self, path):
+    def find_bbfiles(self, path, searched=None):
         """Find all the .bb and .bbappend files in a directory"""
         found = []
-        for dir, dirs, files in os.walk(path):
+        for dir, dirs, files in walk(path):
+            if searched is not None:
+                searched.append(dir)
             for ignored in ('SCCS', 'CVS', '.svn'):
                 if ignored in dirs:
                     dirs.remove(ignored)
-            found += [os.path.join(dir, f) for f in files if (f.endswith(['.bb', '.bbappend']))]
+            found += [os.path.join(dir, f) for f in files if f.endswith(recipe_suffixes)]
 
         return found
 
+    def walk_bbfiles(self, path):
+        searched = []
+        return self.find_bbfiles(path, searched), searched
+
+    def search_bbfiles(self, files, cachefile=None):
+        """
+        Expand the BBFILES entries into a list of .bb and .bbappend files,
+        saving the result to cachefile if given
+        """
+        start = time.time()
+        searched = []
+
+        # Walking a layer is mostly spent waiting on the filesystem, so walk
+        # the directories in parallel
+        dirs = []
+        for f in files:
+            if f not in dirs and os.path.isdir(f):
+                dirs.append(f)
+        found = {}
+        if len(dirs) > 1:
+            pool = ThreadPool(min(8, len(dirs)))
+            try:
+                results = pool.map(self.walk_bbfiles, dirs)
+            finally:
+                pool.close()
+                pool.join()
+            found = dict(zip(dirs, results))
+        else:
+            for f in dirs:
+                found[f] = self.walk_bbfiles(f)
+
+        # Can't use set here as order is important
+        newfiles = []
+        seen = set()
+        for f in files:
+            if f in found:
+                dirfiles, dirsearched = found[f]
+                searched.extend(dirsearched)
+                for g in dirfiles:
+                    if g not in seen:
+                        seen.add(g)
+                        newfiles.append(g)
+            else:
+                searched.extend(glob_dirs(f))
+                if not glob.has_magic(f):
+                    globbed = [f] if os.path.lexists(f) else []
+                else:
+                    globbed = glob.iglob(f)
+                    first = next(globbed, None)
+                    if first is not None:
+                        globbed = itertools.chain([first], globbed)
+                    elif os.path.exists(f):
+                        globbed = [f]
+                for g in globbed:
+                    if g not in seen:
+                        seen.add(g)
+                        newfiles.append(g)
+
+        if cachefile:
+            stamps = [(d, dir_mtime(d)) for d in searched]
+            # A directory modified within the timestamp granularity of the
+            # search could change again without its mtime moving on
+            if all(mtime is None or mtime < int(start) - 1 for _, mtime in stamps):
+                self.save_filelist_cache(cachefile, files, stamps, newfiles)
+
+        return newfiles
+
+    def load_filelist_cache(self, cachefile, files):
+        """
+        Return the file list saved by search_bbfiles for files, or None if
+        there isn't one or any of the directories searched have changed
+        """
+        if not cachefile:
+            return None
+
+        try:
+            with open(cachefile, "rb") as f:
+                version, cachedfiles, stamps, newfiles = pickle.load(f)
+        except Exception:
+            return None
+
+        if version != self.FILELIST_CACHE_VERSION or cachedfiles != files:
+            return None
+
+        for d, mtime in stamps:
+            if dir_mtime(d) != mtime:
+                return None
+
+        collectlog.debug(1, "using cached .bb file list from %s", cachefile)
+        return newfiles
+
+    def save_filelist_cache(self, cachefile, files, stamps, newfiles):
+        try:
+            bb.utils.mkdirhier(os.path.dirname(cachefile))
+            tmpfile = "%s.%s" % (cachefile, os.getpid())
+            with open(tmpfile, "wb") as f:
+                pickle.dump([self.FILELIST_CACHE_VERSION, files, stamps, newfiles], f, -1)
+            os.rename(tmpfile, cachefile)
+        except (OSError, IOError) as exc:
+            collectlog.debug(1, "unable to save .bb file list to %s: %s", cachefile, exc)
+
     def collect_bbfiles(self, config, eventdata):
         """Collect all available .bb build files"""
         masked = 0
@@ -1467,27 +1973,21 @@ class CookerCollectFiles(object):
             collectlog.error("no recipe files to build, check your BBPATH and BBFILES?")
             bb.event.fire(CookerExit(), eventdata)
 
-        # Can't use set here as order is important
-        newfiles = []
-        for f in files:
-            if os.path.isdir(f):
-                dirfiles = self.find_bbfiles(f)
-                for g in dirfiles:
-                    if g not in newfiles:
-                        newfiles.append(g)
-            else:
-                globbed = glob.glob(f)
-                if not globbed and os.path.exists(f):
-                    globbed = [f]
-                for g in globbed:
-                    if g not in newfiles:
-                        newfiles.append(g)
+        cachefile = None
+        cachedir = (config.getVar("PERSISTENT_DIR", True) or
+                    config.getVar("CACHE", True))
+        if cachedir and config.getVar("BBFILES", True):
+            cachefile = os.path.join(cachedir, "bb_filelist.dat")
+
+        newfiles = self.load_filelist_cache(cachefile, files)
+        if newfiles is None:
+            newfiles = self.search_bbfiles(files, cachefile)
 
         bbmask = config.getVar('BBMASK', True)
 
         if bbmask:
             try:
-                bbmask_compiled = re.compile(bbmask)
+                bbmask_compiled = compile_regex(bbmask)
             except sre_constants.error:
                 collectlog.critical("BBMASK is not a valid regular expression, ignoring.")
                 return list(newfiles), 0
@@ -1495,36 +1995,44 @@ class CookerCollectFiles(object):
         bbfiles = []
         bbappend = []
         for f in newfiles:
-            if bbmask and bbmask_compiled.search(f):
-                collectlog.debug(1, "skipping masked file %s", f)
-                masked += 1
-                continue
             if f.endswith('.bb'):
-                bbfiles.append(f)
+                target = bbfiles
             elif f.endswith('.bbappend'):
-                bbappend.append(f)
+                target = bbappend
             else:
                 collectlog.debug(1, "skipping %s: unknown file extension", f)
+                continue
+            if bbmask and bbmask_compiled.search(f):
+                collectlog.debug(1, "skipping masked file %s", f)
+                masked += 1
+                continue
+            target.append(f)
+
+        basename = os.path.basename
 
         # Build a list of .bbappend files for each .bb file
+        known_appends = set(itertools.chain.from_iterable(self.appendlist.itervalues()))
         for f in bbappend:
-            base = os.path.basename(f).replace('.bbappend', '.bb')
+            if f in known_appends:
+                continue
+            known_appends.add(f)
+            base = basename(f).replace('.bbappend', '.bb')
             if not base in self.appendlist:
                self.appendlist[base] = []
-            if f not in self.appendlist[base]:
-                self.appendlist[base].append(f)
+            self.appendlist[base].append(f)
+        self.append_index = None
+        self.file_appends = {}
 
         # Find overlayed recipes
         # bbfiles will be in priority order which makes this easy
         bbfile_seen = dict()
-        self.overlayed = defaultdict(list)
+        overlayed = defaultdict(list)
         for f in reversed(bbfiles):
-            base = os.path.basename(f)
-            if base not in bbfile_seen:
-                bbfile_seen[base] = f
-            else:
-                topfile = bbfile_seen[base]
-                self.overlayed[topfile].append(f)
+            base = basename(f)
+            topfile = bbfile_seen.setdefault(base, f)
+            if topfile != f:
+                overlayed[topfile].append(f)
+        self.overlayed = overlayed
 
         return (bbfiles, masked)
 
@@ -1532,23 +2040,61 @@ class CookerCollectFiles(object):
         """
         Returns a list of .bbappend files to apply to fn
         """
-        filelist = []
+        # The same recipes are looked up over and over, for parsing and
+        # again for each of their tasks
+        filelist = self.file_appends.get(fn)
+        if filelist is not None:
+            return list(filelist)
+
+        if self.append_index is None:
+            # The order of appendlist decides the order the appends are
+            # applied in when more than one entry matches, so remember it
+            order = {}
+            wildcards = []
+            for i, bbappend in enumerate(self.appendlist):
+                order[bbappend] = i
+                if '%' in bbappend:
+                    wildcards.append((bbappend.index('%'), bbappend))
+            self.append_index = (order, wildcards)
+        order, wildcards = self.append_index
+
         f = os.path.basename(fn)
-        for bbappend in self.appendlist:
-            if (bbappend == f) or ('%' in bbappend and bbappend.startswith(f[:bbappend.index('%')])):
-                self.appliedappendlist.append(bbappend)
-                for filename in self.appendlist[bbappend]:
-                    filelist.append(filename)
-        return filelist
+        matches = [bbappend for prefixlen, bbappend in wildcards
+                   if bbappend != f and bbappend.startswith(f[:prefixlen])]
+        if f in order:
+            matches.append(f)
+        if len(matches) > 1:
+            matches.sort(key=order.get)
+
+        filelist = []
+        for bbappend in matches:
+            filelist.extend(self.appendlist[bbappend])
+        self.file_appends[fn] = filelist
+        return list(filelist)
+
+    def get_applied_appends(self):
+        """
+        Returns the set of appendlist entries applied to any recipe so far
+        """
+        # Each .bbappend file belongs to a single entry, so the entries
+        # applied can be worked out from the appends handed out
+        applied = set(itertools.chain.from_iterable(self.file_appends.itervalues()))
+        return set(bbappend for bbappend, filelist in self.appendlist.iteritems()
+                   if filelist[0] in applied)
 
     def collection_priorities(self, pkgfns):
 
         priorities = {}
 
         # Calculate priorities for each file
+        # Most entries aren't virtual and are already real filenames, the
+        # priority itself is remembered per real filename
         matched = set()
+        virtualfn2realfn = bb.cache.Cache.virtualfn2realfn
         for p in pkgfns:
-            realfn, cls = bb.cache.Cache.virtualfn2realfn(p)
+            realfn = p
+            if p.startswith('virtual:'):
+                realfn = virtualfn2realfn(p)[0]
             priorities[p] = self.calc_bbfile_priority(realfn, matched)
  
         # Don't show the warning if the BBFILE_PATTERN did match .bbappend files
@@ -1557,16 +2103,13 @@ class CookerCollectFiles(object):
             if not regex in matched:
                 unmatched.add(regex)
 
-        def findmatch(regex):
-            for bbfile in self.appendlist:
-                for append in self.appendlist[bbfile]:
-                    if regex.match(append):
-                        return True
-            return False
-
-        for unmatch in unmatched.copy():
-            if findmatch(unmatch):
-                unmatched.remove(unmatch)
+        # One pass over the appends, only trying the patterns which haven't
+        # matched anything yet and stopping once they all have
+        if unmatched:
+            for append in itertools.chain.from_iterable(self.appendlist.itervalues()):
+                unmatched.difference_update([regex for regex in unmatched if regex.match(append)])
+                if not unmatched:
+                    break
 
         for collection, pattern, regex, _ in self.bbfile_config_priorities:
             if regex in unmatched:
@@ -1580,114 +2123,92 @@ class ParsingFailure(Exception):
         self.recipe = recipe
         Exception.__init__(self, realexception, recipe)
 
-class Feeder(multiprocessing.Process):
-    def __init__(self, jobs, to_parsers, quit):
-        self.quit = quit
-        self.jobs = jobs
-        self.to_parsers = to_parsers
-        multiprocessing.Process.__init__(self)
-
-    def run(self):
-        while True:
-            try:
-                quit = self.quit.get_nowait()
-            except Queue.Empty:
-                pass
-            else:
-                if quit == 'cancel':
-                    self.to_parsers.cancel_join_thread()
-                break
-
-            try:
-                job = self.jobs.pop()
-            except IndexError:
-                break
-
-            try:
-                self.to_parsers.put(job, timeout=0.5)
-            except Queue.Full:
-                self.jobs.insert(0, job)
-                continue
-
-class Parser(multiprocessing.Process):
-    def __init__(self, jobs, results, quit, init, profile):
-        self.jobs = jobs
-        self.results = results
-        self.quit = quit
-        self.init = init
-        multiprocessing.Process.__init__(self)
-        self.context = bb.utils.get_context().copy()
-        self.handlers = bb.event.get_class_handlers().copy()
-        self.profile = profile
-
-    def run(self):
-
-        if not self.profile:
-            self.realrun()
-            return
-
+class Parser(object):
+    """
+    State shared by the recipes parsed in one pool worker, set up by
+    parse_init() when the worker starts.
+    """
+    cfg = None
+    context = None
+    handlers = None
+    handlers_generation = None
+    profiler = None
+    parsed = 0
+    gc_interval = 50
+
+def parse_init(cfg, profiling):
+    Parser.cfg = cfg
+    Parser.context = bb.utils.get_context().copy()
+    Parser.handlers = bb.event.get_class_handlers().copy()
+    Parser.handlers_generation = bb.event.get_class_handlers_generation()
+    # The workers inherit the server's handlers, which only flag a shutdown,
+    # and the pool could then never terminate them
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, args=(cfg,), exitpriority=1)
+    multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, args=(cfg,), exitpriority=1)
+
+    if profiling:
         try:
             import cProfile as profile
         except:
             import profile
-        prof = profile.Profile()
-        try:
-            profile.Profile.runcall(prof, self.realrun)
-        finally:
-            logfile = "profile-parse-%s.log" % multiprocessing.current_process().name
-            prof.dump_stats(logfile)
-            bb.utils.process_profilelog(logfile)
-            print("Raw profiling information saved to %s and processed statistics to %s.processed" % (logfile, logfile))
-
-    def realrun(self):
-        if self.init:
-            self.init()
-
-        pending = []
-        while True:
-            try:
-                self.quit.get_nowait()
-            except Queue.Empty:
-                pass
-            else:
-                self.results.cancel_join_thread()
-                break
-
-            if pending:
-                result = pending.pop()
-            else:
-                try:
-                    job = self.jobs.get(timeout=0.25)
-                except Queue.Empty:
-                    continue
-
-                if job is None:
-                    break
-                result = self.parse(*job)
-
-            try:
-                self.results.put(result, timeout=0.25)
-            except Queue.Full:
-                pending.append(result)
-
-    def parse(self, filename, appends, caches_array):
-        try:
-            # Reset our environment and handlers to the original settings
-            bb.utils.set_context(self.context.copy())
-            bb.event.set_class_handlers(self.handlers.copy())
-            return True, bb.cache.Cache.parse(filename, appends, self.cfg, caches_array)
-        except Exception as exc:
-            tb = sys.exc_info()[2]
-            exc.recipe = filename
-            exc.traceback = list(bb.exceptions.extract_traceback(tb, context=3))
-            return True, exc
-        # Need to turn BaseExceptions into Exceptions here so we gracefully shutdown
-        # and for example a worker thread doesn't just exit on its own in response to
-        # a SystemExit event for example.
-        except BaseException as exc:
-            return True, ParsingFailure(exc, filename)
+        Parser.profiler = profile.Profile()
+        multiprocessing.util.Finalize(None, parse_profile_save, exitpriority=2)
+
+    # The automatic collections keep walking the configuration data, which
+    # lives for as long as the worker does, so collect the young generations
+    # every few recipes instead. The parent has already moved everything we
+    # inherit to the oldest generation, a collection here would only copy
+    # the pages we share with it.
+    gc.disable()
+
+def parse_profile_save():
+    logfile = "profile-parse-%s.log" % multiprocessing.current_process().name
+    Parser.profiler.dump_stats(logfile)
+    bb.utils.process_profilelog(logfile)
+    print("Raw profiling information saved to %s and processed statistics to %s.processed" % (logfile, logfile))
+
+def parse_one(job):
+    if Parser.profiler:
+        parsed, result = Parser.profiler.runcall(parse_recipe, *job)
+    else:
+        parsed, result = parse_recipe(*job)
+
+    Parser.parsed += 1
+    if Parser.parsed % Parser.gc_interval == 0:
+        # A full collection now and again still frees any cycles which
+        # made it into the oldest generation
+        gc.collect(2 if Parser.parsed % (Parser.gc_interval * 10) == 0 else 1)
+    return parsed, result
+
+def parse_batch(jobs):
+    return [parse_one(job) for job in jobs]
+
+def parse_recipe(filename, appends, caches_array):
+    try:
+        # Reset our environment and handlers to the original settings. The
+        # context is a handful of entries which any exec can change, but the
+        # handlers are only copied if a previous recipe changed them.
+        bb.utils.set_context(Parser.context.copy())
+        if bb.event.get_class_handlers_generation() != Parser.handlers_generation:
+            bb.event.set_class_handlers(Parser.handlers.copy())
+            Parser.handlers_generation = bb.event.get_class_handlers_generation()
+        return True, bb.cache.Cache.parse(filename, appends, Parser.cfg, caches_array)
+    except Exception as exc:
+        tb = sys.exc_info()[2]
+        exc.recipe = filename
+        exc.traceback = list(bb.exceptions.extract_traceback(tb, context=3))
+        return True, exc
+    # Need to turn BaseExceptions into Exceptions here so we gracefully shutdown
+    # and for example a worker process doesn't just exit on its own in response to
+    # a SystemExit event for example.
+    except BaseException as exc:
+        return True, ParsingFailure(exc, filename)
 
 class CookerParser(object):
+    batch_size = 16
+
     def __init__(self, cooker, filelist, masked):
         self.filelist = filelist
         self.cooker = cooker
@@ -1711,39 +2232,62 @@ class CookerParser(object):
         self.bb_cache = bb.cache.Cache(self.cfgdata, self.cfghash, cooker.caches_array)
         self.fromcache = []
         self.willparse = []
-        for filename in self.filelist:
-            appends = self.cooker.collection.get_file_appends(filename)
+        fileappends = [(filename, self.cooker.collection.get_file_appends(filename))
+                       for filename in self.filelist]
+
+        # Checking the cache means a stat() of each recipe and everything it
+        # depends on, so run the checks on a thread pool to overlap the I/O.
+        # The results are remembered by the cache, the loop below then
+        # sorts the recipes in order.
+        if self.bb_cache.has_cache and len(fileappends) > 1:
+            pool = ThreadPool(min(32, len(fileappends)))
+            try:
+                pool.map(lambda args: self.bb_cache.cacheValid(*args), fileappends)
+            finally:
+                pool.close()
+                pool.join()
+
+        for filename, appends in fileappends:
             if not self.bb_cache.cacheValid(filename, appends):
                 self.willparse.append((filename, appends, cooker.caches_array))
             else:
                 self.fromcache.append((filename, appends))
         self.toparse = self.total - len(self.fromcache)
-        self.progress_chunk = max(self.toparse / 100, 1)
+        self.progress_chunk = max(self.toparse // 100, 1)
+        self.next_progress = self.progress_chunk
 
+        self.cache_writer = None
         self.start()
         self.haveshutdown = False
 
     def start(self):
         self.results = self.load_cached()
-        self.processes = []
         if self.toparse:
             bb.event.fire(bb.event.ParseStarted(self.toparse), self.cfgdata)
-            def init():
-                Parser.cfg = self.cfgdata
-                multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, args=(self.cfgdata,), exitpriority=1)
-                multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, args=(self.cfgdata,), exitpriority=1)
-
-            self.feeder_quit = multiprocessing.Queue(maxsize=1)
-            self.parser_quit = multiprocessing.Queue(maxsize=self.num_processes)
-            self.jobs = multiprocessing.Queue(maxsize=self.num_processes)
-            self.result_queue = multiprocessing.Queue()
-            self.feeder = Feeder(self.willparse, self.jobs, self.feeder_quit)
-            self.feeder.start()
-            for i in range(0, self.num_processes):
-                parser = Parser(self.jobs, self.result_queue, self.parser_quit, init, self.cooker.configuration.profile)
-                parser.start()
-                self.processes.append(parser)
-
+            # The workers are forked from us and share our memory until they
+            # write to it. Settle the heap first so that their collections
+            # don't need to touch the objects they inherit.
+            gc.collect()
+            self.pool = bb.utils.multiprocessingpool(self.num_processes, parse_init,
+                                                     (self.cfgdata, self.cooker.configuration.profile))
+            if self.bb_cache.has_cache:
+                self.cache_queue = Queue.Queue()
+                self.cache_writer = threading.Thread(target=self.write_cache)
+                self.cache_writer.start()
+
+            # Hand out jobs in batches to cut down on the IPC overhead per
+            # recipe, while keeping them small enough to spread the work
+            # over the workers. Finished batches are queued up by the pool's
+            # result thread, which writes to a pipe to wake us up.
+            self.ready = deque()
+            self.wakeup = os.pipe()
+            bb.utils.nonblockingfd(self.wakeup[1])
+            batchsize = max(1, min(self.batch_size, self.toparse // (self.num_processes * 4)))
+            self.pending = 0
+            for i in xrange(0, len(self.willparse), batchsize):
+                self.pool.apply_async(parse_batch, (self.willparse[i:i + batchsize],),
+                                      callback=self.batch_parsed)
+                self.pending += 1
             self.results = itertools.chain(self.results, self.parse_generator())
 
     def shutdown(self, clean=True, force=False):
@@ -1760,25 +2304,15 @@ class CookerParser(object):
                                             self.total)
 
             bb.event.fire(event, self.cfgdata)
-            self.feeder_quit.put(None)
-            for process in self.processes:
-                self.jobs.put(None)
+            self.pool.close()
         else:
-            self.feeder_quit.put('cancel')
-
-            self.parser_quit.cancel_join_thread()
-            for process in self.processes:
-                self.parser_quit.put(None)
-
-            self.jobs.cancel_join_thread()
-
-        for process in self.processes:
-            if force:
-                process.join(.1)
-                process.terminate()
-            else:
-                process.join()
-        self.feeder.join()
+            self.pool.terminate()
+        self.pool.join()
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+        if self.cache_writer:
+            self.cache_queue.put(None)
+            self.cache_writer.join()
 
         sync = threading.Thread(target=self.bb_cache.sync)
         sync.start()
@@ -1786,93 +2320,112 @@ class CookerParser(object):
         bb.codeparser.parser_cache_savemerge(self.cooker.data)
         bb.fetch.fetcher_parse_done(self.cooker.data)
 
+    def write_cache(self):
+        # Write the cache entries out while parsing goes on, sync() is then
+        # left with only the entries which never came through here
+        try:
+            while True:
+                result = self.cache_queue.get()
+                if result is None:
+                    break
+                for virtualfn, info_array in result:
+                    self.bb_cache.sync_info(virtualfn, info_array)
+        except Exception:
+            logger.exception("Unable to write the cache during parsing")
+            self.bb_cache.finish_sync(False)
+            self.bb_cache.synced.clear()
+
     def load_cached(self):
         for filename, appends in self.fromcache:
             cached, infos = self.bb_cache.load(filename, appends, self.cfgdata)
             yield not cached, infos
 
-    def parse_generator(self):
-        while True:
-            if self.parsed >= self.toparse:
-                break
+    def batch_parsed(self, results):
+        self.ready.append(results)
+        try:
+            os.write(self.wakeup[1], "x")
+        except OSError as exc:
+            # The pipe is full, so there is a wakeup pending already
+            if exc.errno != errno.EAGAIN:
+                raise
 
+    def parse_generator(self):
+        while self.pending:
+            # Block until a batch is done rather than polling, this also
+            # keeps us responsive to signals
             try:
-                result = self.result_queue.get(timeout=0.25)
-            except Queue.Empty:
-                pass
-            else:
-                value = result[1]
-                if isinstance(value, BaseException):
-                    raise value
-                else:
+                select.select([self.wakeup[0]], [], [])
+            except select.error as exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                raise
+            os.read(self.wakeup[0], 4096)
+
+            while self.ready:
+                self.pending -= 1
+                for result in self.ready.popleft():
                     yield result
 
     def parse_next(self):
-        result = []
-        parsed = None
         try:
             parsed, result = self.results.next()
         except StopIteration:
             self.shutdown()
             return False
-        except bb.BBHandledException as exc:
-            self.error += 1
-            logger.error('Failed to parse recipe: %s' % exc.recipe)
-            self.shutdown(clean=False)
-            return False
-        except ParsingFailure as exc:
-            self.error += 1
-            logger.error('Unable to parse %s: %s' %
-                     (exc.recipe, bb.exceptions.to_string(exc.realexception)))
-            self.shutdown(clean=False)
-            return False
-        except bb.parse.ParseError as exc:
-            self.error += 1
-            logger.error(str(exc))
-            self.shutdown(clean=False)
-            return False
-        except bb.data_smart.ExpansionError as exc:
-            self.error += 1
-            _, value, _ = sys.exc_info()
-            logger.error('ExpansionError during parsing %s: %s', value.recipe, str(exc))
-            self.shutdown(clean=False)
-            return False
-        except SyntaxError as exc:
-            self.error += 1
-            logger.error('Unable to parse %s', exc.recipe)
-            self.shutdown(clean=False)
-            return False
         except Exception as exc:
-            self.error += 1
-            etype, value, tb = sys.exc_info()
-            if hasattr(value, "recipe"):
-                logger.error('Unable to parse %s', value.recipe,
-                            exc_info=(etype, value, exc.traceback))
-            else:
-                # Most likely, an exception occurred during raising an exception
-                import traceback
-                logger.error('Exception during parse: %s' % traceback.format_exc())
-            self.shutdown(clean=False)
-            return False
+            return self.parse_failed(exc, sys.exc_info()[2])
+
+        # Failures in the parsers come back as the result rather than being
+        # raised, so the common path doesn't go through exception handling
+        if isinstance(result, BaseException):
+            return self.parse_failed(result)
 
         self.current += 1
         self.virtuals += len(result)
         if parsed:
             self.parsed += 1
-            if self.parsed % self.progress_chunk == 0:
+            if self.parsed >= self.next_progress:
+                self.next_progress += self.progress_chunk
                 bb.event.fire(bb.event.ParseProgress(self.parsed, self.toparse),
                               self.cfgdata)
         else:
             self.cached += 1
 
+        add_info = self.bb_cache.add_info
+        recipecache = self.cooker.recipecache
         for virtualfn, info_array in result:
             if info_array[0].skipped:
                 self.skipped += 1
                 self.cooker.skiplist[virtualfn] = SkippedPackage(info_array[0])
-            self.bb_cache.add_info(virtualfn, info_array, self.cooker.recipecache,
-                                        parsed=parsed)
+            add_info(virtualfn, info_array, recipecache, parsed=parsed)
+        if self.cache_writer:
+            self.cache_queue.put(result)
         return True
 
+    def parse_failed(self, exc, tb=None):
+        self.error += 1
+        if isinstance(exc, bb.BBHandledException):
+            logger.error('Failed to parse recipe: %s' % exc.recipe)
+        elif isinstance(exc, ParsingFailure):
+            logger.error('Unable to parse %s: %s' %
+                     (exc.recipe, bb.exceptions.to_string(exc.realexception)))
+        elif isinstance(exc, bb.parse.ParseError):
+            logger.error(str(exc))
+        elif isinstance(exc, bb.data_smart.ExpansionError):
+            logger.error('ExpansionError during parsing %s: %s', exc.recipe, str(exc))
+        elif isinstance(exc, SyntaxError):
+            logger.error('Unable to parse %s', exc.recipe)
+        elif hasattr(exc, "recipe"):
+            logger.error('Unable to parse %s', exc.recipe,
+                        exc_info=(type(exc), exc, getattr(exc, "traceback", tb)))
+        else:
+            # Most likely, an exception occurred during raising an exception
+            import traceback
+            logger.error('Exception during parse: %s' %
+                         "".join(traceback.format_exception(type(exc), exc, tb)))
+        self.shutdown(clean=False)
+        return False
+
     def reparse(self, filename):
         infos = self.bb_cache.parse(filename,
                                     self.cooker.collection.get_file_appends(filename),
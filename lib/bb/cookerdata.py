@@ -53,19 +53,27 @@ class ConfigParameters(object):
         return os.environ.copy()
 
     def updateFromServer(self, server):
+        # Fetch whichever defaults are needed in a single command
+        varnames = []
         if not self.options.cmd:
-            defaulttask, error = server.runCommand(["getVariable", "BB_DEFAULT_TASK"])
+            varnames.append("BB_DEFAULT_TASK")
+        if not self.options.pkgs_to_build:
+            varnames.append("BBPKGS")
+        values = {}
+        if varnames:
+            ret, error = server.runCommand(["getVariables"] + varnames)
             if error:
-                raise Exception("Unable to get the value of BB_DEFAULT_TASK from the server: %s" % error)
-            self.options.cmd = defaulttask or "build"
+                raise Exception("Unable to get the value of %s from the server: %s" % (" and ".join(varnames), error))
+            values = dict(zip(varnames, ret))
+
+        if not self.options.cmd:
+            self.options.cmd = values["BB_DEFAULT_TASK"] or "build"
         _, error = server.runCommand(["setConfig", "cmd", self.options.cmd])
         if error:
             raise Exception("Unable to set configuration option 'cmd' on the server: %s" % error)
 
         if not self.options.pkgs_to_build:
-            bbpkgs, error = server.runCommand(["getVariable", "BBPKGS"])
-            if error:
-                raise Exception("Unable to get the value of BBPKGS from the server: %s" % error)
+            bbpkgs = values["BBPKGS"]
             if bbpkgs:
                 self.options.pkgs_to_build.extend(bbpkgs.split())
 
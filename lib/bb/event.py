@@ -55,13 +55,20 @@ def get_class_handlers():
     return _handlers
 
 def set_class_handlers(h):
+    global _handlers, _handlers_generation
     _handlers = h
+    _handlers_generation += 1
+
+def get_class_handlers_generation():
+    """Return a counter which changes whenever the class handlers do"""
+    return _handlers_generation
 
 def clean_class_handlers():
     return bb.compat.OrderedDict()
 
 # Internal
 _handlers = clean_class_handlers()
+_handlers_generation = 0
 _ui_handlers = {}
 _ui_logfilters = {}
 _ui_handler_seq = 0
@@ -167,12 +174,15 @@ def fire_from_worker(event, d):
 noop = lambda _: None
 def register(name, handler, mask=[]):
     """Register an Event handler"""
+    global _handlers_generation
 
     # already registered
     if name in _handlers:
         return AlreadyRegistered
 
     if handler is not None:
+        _handlers_generation += 1
+
         # handle string containing python code
         if isinstance(handler, basestring):
             tmp = "def %s(e):\n%s" % (name, handler)
@@ -202,6 +212,8 @@ def register(name, handler, mask=[]):
 
 def remove(name, handler):
     """Remove an Event handler"""
+    global _handlers_generation
+    _handlers_generation += 1
     _handlers.pop(name)
 
 def register_UIHhandler(handler):
@@ -515,6 +527,15 @@ class ConfigFilesFound(Event):
         self._variable = variable
         self._values = values
 
+class ConfigFilesFoundBatch(Event):
+    """
+    Event carrying several ConfigFilesFound results, as (variable, values)
+    pairs, collected with findConfigFiles(..., coalesce=True)
+    """
+    def __init__(self, entries):
+        Event.__init__(self)
+        self._entries = entries
+
 class ConfigFilePathFound(Event):
     """
     Event when a path for a config file has been found
@@ -0,0 +1,90 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for cooker.py
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import threading
+import signal
+import os
+import bb
+import bb.cache_extra
+import bb.cooker
+import bb.cookerdata
+
+class CookerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.write("conf/bblayers.conf",
+                   'BBPATH = "%s"\n'
+                   'BBFILES = "%s/recipes/*.bb"\n' % (self.tempdir, self.tempdir))
+        self.write("conf/bitbake.conf",
+                   'CACHE = "${TOPDIR}/cache"\n'
+                   'PN = "${@bb.parse.BBHandler.vars_from_file(d.getVar(\'FILE\'),d)[0]}"\n'
+                   'PV = "${@bb.parse.BBHandler.vars_from_file(d.getVar(\'FILE\'),d)[1]}"\n'
+                   'PR = "r0"\n'
+                   'STAMP = "${TOPDIR}/stamps/${PN}"\n'
+                   'T = "${TOPDIR}/work/${PN}"\n'
+                   'BB_NUMBER_PARSE_THREADS = "1"\n')
+        self.write("classes/base.bbclass",
+                   'do_build () {\n'
+                   '\t:\n'
+                   '}\n'
+                   'addtask build\n')
+        self.write("recipes/foo_1.0.bb",
+                   'SUMMARY = "A test recipe"\n'
+                   'LICENSE = "MIT"\n')
+
+        self.cwd = os.getcwd()
+        self.handlers = (signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGHUP))
+        os.chdir(self.tempdir)
+        self.cooker = bb.cooker.BBCooker(bb.cookerdata.CookerConfiguration())
+
+    def tearDown(self):
+        # Let the cache finish writing before its directory goes away
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join()
+        bb.utils.unlockfile(self.cooker.lock)
+        signal.signal(signal.SIGTERM, self.handlers[0])
+        signal.signal(signal.SIGHUP, self.handlers[1])
+        os.chdir(self.cwd)
+        bb.utils.prunedir(self.tempdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tempdir, name)
+        bb.utils.mkdirhier(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    def parse(self):
+        while self.cooker.updateCache():
+            pass
+        self.cooker.finishcommand()
+
+    def test_extra_caches_after_parsing(self):
+        fn = os.path.join(self.tempdir, "recipes/foo_1.0.bb")
+        self.parse()
+        self.assertIn(fn, self.cooker.recipecache.pkg_fn)
+        self.assertFalse(hasattr(self.cooker.recipecache, "summary"))
+
+        self.cooker.setFeatures([bb.cooker.CookerFeatures.HOB_EXTRA_CACHES])
+        self.parse()
+        self.assertEqual(self.cooker.recipecache.summary[fn], "A test recipe")
+        self.assertEqual(self.cooker.recipecache.license[fn], "MIT")
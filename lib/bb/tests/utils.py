@@ -51,3 +51,32 @@ class VerCmpString(unittest.TestCase):
         result = bb.utils.explode_dep_versions2("foo ( =1.10 )")
         self.assertEqual(result, correctresult)
 
+
+class Context(unittest.TestCase):
+
+    def setUp(self):
+        self.context = bb.utils.get_context()
+        self.handlers = bb.event.get_class_handlers()
+
+    def tearDown(self):
+        bb.utils.set_context(self.context)
+        bb.event.set_class_handlers(self.handlers)
+
+    def test_set_context(self):
+        ctx = bb.utils.clean_context()
+        ctx["foo"] = "bar"
+        bb.utils.set_context(ctx)
+        self.assertIs(bb.utils.get_context(), ctx)
+        self.assertEqual(bb.utils.better_eval("foo", {}), "bar")
+
+    def test_set_class_handlers(self):
+        handlers = bb.event.clean_class_handlers()
+        generation = bb.event.get_class_handlers_generation()
+        bb.event.set_class_handlers(handlers)
+        self.assertIs(bb.event.get_class_handlers(), handlers)
+        self.assertNotEqual(bb.event.get_class_handlers_generation(), generation)
+
+        generation = bb.event.get_class_handlers_generation()
+        bb.event.register("test_handler", lambda e: None)
+        self.assertIn("test_handler", handlers)
+        self.assertNotEqual(bb.event.get_class_handlers_generation(), generation)
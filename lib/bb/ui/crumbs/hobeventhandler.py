@@ -79,7 +79,8 @@ class HobHandler(gobject.GObject):
 
     (GENERATE_CONFIGURATION, GENERATE_RECIPES, GENERATE_PACKAGES, GENERATE_IMAGE, POPULATE_PACKAGEINFO, SANITY_CHECK, NETWORK_TEST) = range(7)
     (SUB_PATH_LAYERS, SUB_FILES_DISTRO, SUB_FILES_MACH, SUB_FILES_SDKMACH, SUB_MATCH_CLASS, SUB_PARSE_CONFIG, SUB_SANITY_CHECK,
-     SUB_GNERATE_TGTS, SUB_GENERATE_PKGINFO, SUB_BUILD_RECIPES, SUB_BUILD_IMAGE, SUB_NETWORK_TEST) = range(12)
+     SUB_GNERATE_TGTS, SUB_GENERATE_PKGINFO, SUB_BUILD_RECIPES, SUB_BUILD_IMAGE, SUB_NETWORK_TEST,
+     SUB_FLUSH_CONFIG_FILES) = range(13)
 
     def __init__(self, server, recipe_model, package_model):
         super(HobHandler, self).__init__()
@@ -139,11 +140,13 @@ class HobHandler(gobject.GObject):
         if next_command == self.SUB_PATH_LAYERS:
             self.runCommand(["findConfigFilePath", "bblayers.conf"])
         elif next_command == self.SUB_FILES_DISTRO:
-            self.runCommand(["findConfigFiles", "DISTRO"])
+            self.runCommand(["findConfigFiles", "DISTRO", True])
         elif next_command == self.SUB_FILES_MACH:
-            self.runCommand(["findConfigFiles", "MACHINE"])
+            self.runCommand(["findConfigFiles", "MACHINE", True])
         elif next_command == self.SUB_FILES_SDKMACH:
-            self.runCommand(["findConfigFiles", "MACHINE-SDK"])
+            self.runCommand(["findConfigFiles", "MACHINE-SDK", True])
+        elif next_command == self.SUB_FLUSH_CONFIG_FILES:
+            self.runCommand(["flushConfigFileEvents"])
         elif next_command == self.SUB_MATCH_CLASS:
             self.runCommand(["findFilesMatchingInDir", "rootfs_", "classes"])
         elif next_command == self.SUB_PARSE_CONFIG:
@@ -237,6 +240,11 @@ class HobHandler(gobject.GObject):
             values = event._values
             values.sort()
             self.emit("config-updated", var, values)
+        elif isinstance(event, bb.event.ConfigFilesFoundBatch):
+            self.current_phase = "configuration lookup"
+            for var, values in event._entries:
+                values.sort()
+                self.emit("config-updated", var, values)
         elif isinstance(event, bb.event.ConfigFilePathFound):
             self.current_phase = "configuration lookup"
         elif isinstance(event, bb.event.FilesMatchingFound):
@@ -421,6 +429,7 @@ class HobHandler(gobject.GObject):
         self.commands_async.append(self.SUB_FILES_DISTRO)
         self.commands_async.append(self.SUB_FILES_MACH)
         self.commands_async.append(self.SUB_FILES_SDKMACH)
+        self.commands_async.append(self.SUB_FLUSH_CONFIG_FILES)
         self.commands_async.append(self.SUB_MATCH_CLASS)
         self.run_next_command(self.GENERATE_CONFIGURATION)
 
@@ -22,16 +22,16 @@ from __future__ import division
 
 import os
 import sys
-import select
 import xmlrpclib
 import logging
+import logging.handlers
 import progressbar
 import signal
 import bb.msg
 import time
 import fcntl
 import struct
-import copy
+import collections
 import atexit
 from bb.ui import uihelper
 from bb.ui.crumbs.multilogtail import MultiLogTail
@@ -40,6 +40,7 @@ featureSet = [bb.cooker.CookerFeatures.SEND_SANITYEVENTS]
 
 logger = logging.getLogger("BitBake")
 interactive = sys.stdout.isatty()
+winsize = struct.Struct('hh')
 
 class BBProgress(progressbar.ProgressBar):
     def __init__(self, msg, maxval):
@@ -53,6 +54,15 @@ class BBProgress(progressbar.ProgressBar):
             self._resize_default = None
         progressbar.ProgressBar.__init__(self, maxval, [self.msg + ": "] + widgets, fd=sys.stdout)
 
+    def _need_update(self):
+        # Parse and cache load progress can arrive far faster than it is
+        # worth repainting, so limit it to ten times a second
+        if not progressbar.ProgressBar._need_update(self):
+            return False
+        if not self.next_update or self.currval >= self.maxval:
+            return True
+        return time.time() - self.last_update_time >= 0.1
+
     def _handle_resize(self, signum, frame):
         progressbar.ProgressBar._handle_resize(self, signum, frame)
         if self._resize_default:
@@ -62,12 +72,28 @@ class BBProgress(progressbar.ProgressBar):
         if self._resize_default:
             signal.signal(signal.SIGWINCH, self._resize_default)
 
-class NonInteractiveProgress(object):
-    fobj = sys.stdout
+class LevelPrefixFormatter(bb.msg.BBLogFormatter):
+    """
+    Formatter for "%(levelname)s: %(message)s" which puts the common
+    uncoloured records together directly rather than through the generic
+    logging.Formatter machinery
+    """
+    def __init__(self):
+        bb.msg.BBLogFormatter.__init__(self, "%(levelname)s: %(message)s")
 
+    def format(self, record):
+        if self.color_enabled or record.exc_info or record.exc_text or \
+                record.levelno == self.PLAIN or hasattr(record, 'bb_exc_info'):
+            return bb.msg.BBLogFormatter.format(self, record)
+        record.levelname = self.getLevelName(record.levelno)
+        record.message = record.getMessage()
+        return record.levelname + ": " + record.message
+
+class NonInteractiveProgress(object):
     def __init__(self, msg, maxval):
         self.msg = msg
         self.maxval = maxval
+        self.fobj = sys.stdout
 
     def start(self):
         self.fobj.write("%s..." % self.msg)
@@ -105,6 +131,44 @@ class InteractConsoleLogFilter(logging.Filter):
         self.tf.clearFooter()
         return True
 
+class TaskNoteFilter(logging.Filter):
+    """
+    For "normal" logging conditions, don't show note logs from tasks but do
+    show them if the user has changed the default log level to include
+    verbose/debug messages
+    """
+    def __init__(self, llevel, format):
+        self.llevel = llevel
+        self.note = format.NOTE
+        self.hidenotes = llevel != format.VERBOSE
+
+    def filter(self, record):
+        levelno = record.levelno
+        if levelno > self.note or not getattr(record, "taskpid", 0):
+            return True
+        return not (levelno < self.llevel or (levelno == self.note and self.hidenotes))
+
+class FlushStdoutFilter(logging.Filter):
+    """
+    Keeps messages on stderr in order with the ones before them on stdout
+    while stdout is buffered
+    """
+    def filter(self, record):
+        sys.stdout.flush()
+        return True
+
+class BuildStatus(object):
+    """
+    What main() has seen of the build so far
+    """
+    def __init__(self):
+        self.return_value = 0
+        self.errors = 0
+        self.warnings = 0
+        self.taskfailures = []
+        self.parseprogress = None
+        self.cacheprogress = None
+
 class TerminalFilter(object):
     columns = 80
 
@@ -116,7 +180,7 @@ class TerminalFilter(object):
     def getTerminalColumns(self):
         def ioctl_GWINSZ(fd):
             try:
-                cr = struct.unpack('hh', fcntl.ioctl(fd, self.termios.TIOCGWINSZ, '1234'))
+                cr = winsize.unpack(fcntl.ioctl(fd, self.termios.TIOCGWINSZ, '1234'))
             except:
                 return None
             return cr
@@ -130,7 +194,7 @@ class TerminalFilter(object):
                 pass
         if not cr:
             try:
-                cr = (env['LINES'], env['COLUMNS'])
+                cr = (int(os.environ['LINES']), int(os.environ['COLUMNS']))
             except:
                 cr = (25, 80)
         return cr[1]
@@ -144,7 +208,8 @@ class TerminalFilter(object):
         self.stdinbackup = None
         self.interactive = sys.stdout.isatty()
         self.footer_present = False
-        self.lastpids = []
+        self.footer_key = None
+        self.lastversion = None
 
         if not self.interactive:
             return
@@ -160,7 +225,7 @@ class TerminalFilter(object):
         try:
             fd = sys.stdin.fileno()
             self.stdinbackup = termios.tcgetattr(fd)
-            new = copy.deepcopy(self.stdinbackup)
+            new = self.stdinbackup[:6] + [self.stdinbackup[6][:]]
             new[3] = new[3] & ~termios.ECHO
             termios.tcsetattr(fd, termios.TCSADRAIN, new)
             curses.setupterm()
@@ -169,6 +234,10 @@ class TerminalFilter(object):
             self.ed = curses.tigetstr("ed")
             if self.ed:
                 self.cuu = curses.tigetstr("cuu")
+                # The footer is cleared a few times a second, mostly with the
+                # same number of lines, so keep the expanded sequences
+                self.clear_ed = curses.tparm(self.ed)
+                self.clear_cuu = {}
             try:
                 self._sigwinch_default = signal.getsignal(signal.SIGWINCH)
                 signal.signal(signal.SIGWINCH, self.sigwinch_handle)
@@ -200,13 +269,28 @@ class TerminalFilter(object):
     def setFilterOff(self):
         self.filterOn = False
 
+    def writeTerminal(self, data):
+        # Footer updates go straight to the terminal in one write, after
+        # anything still buffered on stdout so the order is kept
+        if isinstance(data, unicode):
+            data = data.encode(sys.stdout.encoding or "ascii")
+        sys.stdout.flush()
+        fd = sys.stdout.fileno()
+        while data:
+            data = data[os.write(fd, data):]
+
+    def clearSequence(self):
+        lines = self.footer_present
+        cuu = self.clear_cuu.get(lines)
+        if cuu is None:
+            cuu = self.clear_cuu[lines] = self.curses.tparm(self.cuu, lines)
+        return cuu + self.clear_ed
+
     def clearFooter(self):
         if not self.topMode:
             return
         if self.footer_present:
-            lines = self.footer_present
-            sys.stdout.write(self.curses.tparm(self.cuu, lines))
-            sys.stdout.write(self.curses.tparm(self.ed))
+            self.writeTerminal(self.clearSequence())
         self.footer_present = False
 
     def updateFooterForce(self):
@@ -219,31 +303,45 @@ class TerminalFilter(object):
         activetasks = self.helper.running_tasks
         failedtasks = self.helper.failed_tasks
         runningpids = self.helper.running_pids
-        if self.footer_present and (self.lastcount == self.helper.tasknumber_current) and (self.lastpids == runningpids):
+        if self.footer_present and self.lastversion == self.helper.tasks_version:
             return
+        # A footer being replaced is erased in the same write as the new one
+        clear = ""
         if self.footer_present:
-            self.clearFooter()
+            clear = self.clearSequence()
+            self.footer_present = False
         if (not self.helper.tasknumber_total or self.helper.tasknumber_current == self.helper.tasknumber_total) and not len(activetasks):
+            if clear:
+                self.writeTerminal(clear)
             return
-        tasks = []
-        for t in runningpids:
-            tasks.append("%s (pid %s)" % (activetasks[t]["title"], t))
-
-        if self.main.shutdown:
-            content = "Waiting for %s running tasks to finish:" % len(activetasks)
-        elif not len(activetasks):
-            content = "No currently running tasks (%s of %s)" % (self.helper.tasknumber_current, self.helper.tasknumber_total)
-        else:
-            content = "Currently %s running tasks (%s of %s):" % (len(activetasks), self.helper.tasknumber_current, self.helper.tasknumber_total)
-        print(content)
-        lines = 1 + int(len(content) / (self.columns + 1))
-        for tasknum, task in enumerate(tasks):
-            content = "%s: %s" % (tasknum, task)
-            print(content)
-            lines = lines + 1 + int(len(content) / (self.columns + 1))
-        self.footer_present = lines
-        self.lastpids = runningpids[:]
-        self.lastcount = self.helper.tasknumber_current
+        # The footer is cleared for every message printed above it, most of
+        # the time it then comes back exactly as it was
+        key = (self.main.shutdown, len(activetasks), self.helper.tasknumber_current,
+               self.helper.tasknumber_total, self.columns,
+               tuple((t, activetasks[t]["title"]) for t in runningpids))
+        if key != self.footer_key:
+            tasks = []
+            for t in runningpids:
+                tasks.append("%s (pid %s)" % (activetasks[t]["title"], t))
+
+            if self.main.shutdown:
+                content = "Waiting for %s running tasks to finish:" % len(activetasks)
+            elif not len(activetasks):
+                content = "No currently running tasks (%s of %s)" % (self.helper.tasknumber_current, self.helper.tasknumber_total)
+            else:
+                content = "Currently %s running tasks (%s of %s):" % (len(activetasks), self.helper.tasknumber_current, self.helper.tasknumber_total)
+            footer = [content + "\n"]
+            lines = 1 + int(len(content) / (self.columns + 1))
+            for tasknum, task in enumerate(tasks):
+                content = "%s: %s" % (tasknum, task)
+                footer.append(content + "\n")
+                lines = lines + 1 + int(len(content) / (self.columns + 1))
+            self.footer_key = key
+            self.footer_text = "".join(footer)
+            self.footer_lines = lines
+        self.writeTerminal(clear + self.footer_text)
+        self.footer_present = self.footer_lines
+        self.lastversion = self.helper.tasks_version
 
     def finish(self):
         if self.stdinbackup:
@@ -261,16 +359,30 @@ class StdinMgr:
             self.stdinbackup = self.termios.tcgetattr(self.fd)
             new = self.termios.tcgetattr(self.fd)
             new[3] = new[3] & ~self.termios.ICANON & ~self.termios.ECHO
-            self.termios.tcsetattr(self.fd, self.termios.TCSANOW, new)
+            self.blockingattrs = new
+            # Reads return straight away when there is no input waiting. This
+            # is left to the terminal rather than O_NONBLOCK, which would be
+            # shared with stdout and stderr
+            self.pollingattrs = new[:6] + [new[6][:]]
+            self.pollingattrs[6][self.termios.VMIN] = 0
+            self.pollingattrs[6][self.termios.VTIME] = 0
+            self.termios.tcsetattr(self.fd, self.termios.TCSANOW, self.pollingattrs)
+
+    def setBlocking(self, blocking):
+        if not self.stdinbackup:
+            return
+        if blocking:
+            self.termios.tcsetattr(self.fd, self.termios.TCSANOW, self.blockingattrs)
+        else:
+            self.termios.tcsetattr(self.fd, self.termios.TCSANOW, self.pollingattrs)
 
-    def poll(self):
+    def readPending(self):
         if not self.stdinbackup:
-            return False
+            return ""
         try:
-            ret = select.select([sys.stdin], [], [], 0) == ([sys.stdin], [], [])
-        except:
-            return False
-        return ret
+            return os.read(self.fd, 64)
+        except OSError:
+            return ""
 
     def restore(self):
         if self.stdinbackup:
@@ -357,23 +469,14 @@ class RtLogLevel:
         return True
 
 def _log_settings_from_server(server):
-    # Get values of variables which control our output
-    includelogs, error = server.runCommand(["getVariable", "BBINCLUDELOGS"])
+    # Get values of variables which control our output, in a single command
+    # so a remote server is only asked once
+    values, error = server.runCommand(["getVariables", "BBINCLUDELOGS", "BBINCLUDELOGS_LINES",
+                                       "BB_CONSOLELOG", "BB_RT_LOGLEVEL"])
     if error:
-        logger.error("Unable to get the value of BBINCLUDELOGS variable: %s" % error)
-        raise BaseException(error)
-    loglines, error = server.runCommand(["getVariable", "BBINCLUDELOGS_LINES"])
-    if error:
-        logger.error("Unable to get the value of BBINCLUDELOGS_LINES variable: %s" % error)
-        raise BaseException(error)
-    consolelogfile, error = server.runCommand(["getVariable", "BB_CONSOLELOG"])
-    if error:
-        logger.error("Unable to get the value of BB_CONSOLELOG variable: %s" % error)
-        raise BaseException(error)
-    bb_rt_loglevel, error = server.runCommand(["getVariable", "BB_RT_LOGLEVEL"])
-    if error:
-        logger.error("Unable to get the value of BB_RT_LOGLEVEL variable: %s" % error)
+        logger.error("Unable to get the values of the BBINCLUDELOGS, BBINCLUDELOGS_LINES, BB_CONSOLELOG and BB_RT_LOGLEVEL variables: %s" % error)
         raise BaseException(error)
+    includelogs, loglines, consolelogfile, bb_rt_loglevel = values
     return includelogs, loglines, consolelogfile, bb_rt_loglevel
 
 _evt_list = [ "bb.runqueue.runQueueExitWait", "bb.event.LogExecTTY", "logging.LogRecord",
@@ -387,6 +490,14 @@ _evt_list = [ "bb.runqueue.runQueueExitWait", "bb.event.LogExecTTY", "logging.Lo
 
 def main(server, eventHandler, params, tf = TerminalFilter):
 
+    if not interactive:
+        # Nobody is watching the output as it happens, so write it out in
+        # large blocks rather than a line at a time. It is flushed whenever
+        # we run out of events to handle.
+        sys.stdout.flush()
+        sys.stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'w', 65536)
+        atexit.register(sys.stdout.flush)
+
     includelogs, loglines, consolelogfile, bb_rt_loglevel = _log_settings_from_server(server)
 
     if sys.stdin.isatty() and sys.stdout.isatty():
@@ -405,10 +516,11 @@ def main(server, eventHandler, params, tf = TerminalFilter):
 
     console = logging.StreamHandler(sys.stdout)
     errconsole = logging.StreamHandler(sys.stderr)
-    format_str = "%(levelname)s: %(message)s"
-    format = bb.msg.BBLogFormatter(format_str)
+    format = LevelPrefixFormatter()
     bb.msg.addDefaultlogFilter(console, bb.msg.BBLogFilterStdOut)
     bb.msg.addDefaultlogFilter(errconsole, bb.msg.BBLogFilterStdErr)
+    if not interactive:
+        errconsole.addFilter(FlushStdoutFilter())
     logfilter = bb.msg.addDefaultlogFilter(console)
     console.setFormatter(format)
     errconsole.setFormatter(format)
@@ -421,13 +533,18 @@ def main(server, eventHandler, params, tf = TerminalFilter):
 
     if consolelogfile and not params.options.show_environment:
         bb.utils.mkdirhier(os.path.dirname(consolelogfile))
-        conlogformat = bb.msg.BBLogFormatter(format_str)
+        conlogformat = LevelPrefixFormatter()
         consolelog = logging.FileHandler(consolelogfile)
         bb.msg.addDefaultlogFilter(consolelog)
         consolelog.setFormatter(conlogformat)
-        logger.addHandler(consolelog)
+        # Write the console log in batches, errors are written straight away
+        consolelogbuffer = logging.handlers.MemoryHandler(512, logging.ERROR, consolelog)
+        logger.addHandler(consolelogbuffer)
+    else:
+        consolelogbuffer = None
 
     llevel, debug_domains = bb.msg.constructLogOptions()
+    logger.addFilter(TaskNoteFilter(llevel, format))
     server.runCommand(["setEventMask", server.getEventHandle(), llevel, debug_domains, _evt_list])
 
     if not params.observe_only:
@@ -450,14 +567,9 @@ def main(server, eventHandler, params, tf = TerminalFilter):
             return 1
 
 
-    parseprogress = None
-    cacheprogress = None
     main.shutdown = 0
     interrupted = False
-    return_value = 0
-    errors = 0
-    warnings = 0
-    taskfailures = []
+    status = BuildStatus()
 
     termfilter = tf(main, helper, console, errconsole, format)
     atexit.register(termfilter.finish)
@@ -467,217 +579,279 @@ def main(server, eventHandler, params, tf = TerminalFilter):
     if bb_rt_loglevel and bb_rt_loglevel != "":
         for inputkey in bb_rt_loglevel:
             rtloglevel.setLevel(inputkey, False)
+
+    def task_started(event):
+        if (rtloglevel.displayLogLocations):
+            termfilter.clearFooter()
+            print "NOTE: LOG: %s" % event.logfile
+        mlt.openLog(event.logfile, event.pid)
+        rtloglevel.displayLogs()
+
+    def task_finished(event):
+        mlt.closeLogPid(event.pid)
+
+    def exit_wait(event):
+        if not main.shutdown:
+            main.shutdown = 1
+
+    def exec_tty(event):
+        if log_exec_tty:
+            tries = event.retries
+            while tries:
+                print("Trying to run: %s" % event.prog)
+                stdin_mgr.setBlocking(True)
+                try:
+                    if os.system(event.prog) == 0:
+                        break
+                finally:
+                    stdin_mgr.setBlocking(False)
+                time.sleep(event.sleep_delay)
+                tries -= 1
+            if tries:
+                return
+        logger.warn(event.msg)
+
+    ERROR, WARNING = format.ERROR, format.WARNING
+
+    def log_record(event):
+        levelno = event.levelno
+        if levelno >= ERROR:
+            status.errors = status.errors + 1
+            status.return_value = 1
+        elif levelno == WARNING:
+            status.warnings = status.warnings + 1
+        logger.handle(event)
+
+    def task_failed_silent(event):
+        logger.warn("Logfile for failed setscene task is %s", event.logfile)
+
+    def task_failed(event):
+        status.return_value = 1
+        logfile = event.logfile
+        if logfile and os.path.exists(logfile):
+            termfilter.clearFooter()
+            bb.error("Logfile of failure stored in: %s" % logfile)
+            if includelogs and not event.errprinted:
+                print("Log data follows:")
+                with open(logfile, "r") as f:
+                    if loglines:
+                        lines = collections.deque((' | %s' % l.rstrip() for l in f), int(loglines))
+                    else:
+                        lines = ['| %s' % l.rstrip() for l in f]
+                if lines:
+                    sys.stdout.write("\n".join(lines) + "\n")
+
+    def task_message(event):
+        logger.info(event._message)
+
+    def parse_started(event):
+        if event.total == 0:
+            return
+        status.parseprogress = new_progress("Parsing recipes", event.total).start()
+
+    def parse_progress(event):
+        status.parseprogress.update(event.current)
+
+    def parse_completed(event):
+        if not status.parseprogress:
+            return
+
+        status.parseprogress.finish()
+        print(("Parsing of %d .bb files complete (%d cached, %d parsed). %d targets, %d skipped, %d masked, %d errors."
+            % ( event.total, event.cached, event.parsed, event.virtuals, event.skipped, event.masked, event.errors)))
+
+    def cache_load_started(event):
+        status.cacheprogress = new_progress("Loading cache", event.total).start()
+
+    def cache_load_progress(event):
+        status.cacheprogress.update(event.current)
+
+    def cache_load_completed(event):
+        status.cacheprogress.finish()
+        print("Loaded %d entries from dependency cache." % event.num_entries)
+
+    def command_failed(event):
+        status.return_value = event.exitcode
+        if event.error:
+            status.errors = status.errors + 1
+            logger.error("Command execution failed: %s", event.error)
+        main.shutdown = 2
+
+    def command_exit(event):
+        if not status.return_value:
+            status.return_value = event.exitcode
+
+    def command_completed(event):
+        main.shutdown = 2
+
+    def multiple_providers(event):
+        logger.info("multiple providers are available for %s%s (%s)", event._is_runtime and "runtime " or "",
+                    event._item,
+                    ", ".join(event._candidates))
+        logger.info("consider defining a PREFERRED_PROVIDER entry to match %s", event._item)
+
+    def no_provider(event):
+        status.return_value = 1
+        status.errors = status.errors + 1
+        if event._runtime:
+            r = "R"
+        else:
+            r = ""
+
+        extra = ''
+        if not event._reasons:
+            if event._close_matches:
+                extra = ". Close matches:\n  %s" % '\n  '.join(event._close_matches)
+
+        if event._dependees:
+            logger.error("Nothing %sPROVIDES '%s' (but %s %sDEPENDS on or otherwise requires it)%s", r, event._item, ", ".join(event._dependees), r, extra)
+        else:
+            logger.error("Nothing %sPROVIDES '%s'%s", r, event._item, extra)
+        if event._reasons:
+            for reason in event._reasons:
+                logger.error("%s", reason)
+
+    def scene_task_started(event):
+        stats = event.stats
+        logger.info("Running setscene task %d of %d (%s)",
+                    stats.completed + stats.active + stats.failed + 1,
+                    stats.total, event.taskstring)
+
+    def runqueue_task_started(event):
+        if event.noexec:
+            tasktype = 'noexec task'
+        else:
+            tasktype = 'task'
+        stats = event.stats
+        logger.info("Running %s %s of %s (ID: %s, %s)",
+                    tasktype,
+                    stats.completed + stats.active + stats.failed + 1,
+                    stats.total, event.taskid, event.taskstring)
+
+    def runqueue_task_failed(event):
+        status.taskfailures.append(event.taskstring)
+        logger.error("Task %s (%s) failed with exit code '%s'",
+                     event.taskid, event.taskstring, event.exitcode)
+
+    def scene_task_failed(event):
+        logger.warn("Setscene task %s (%s) failed with exit code '%s' - real task will be run instead",
+                     event.taskid, event.taskstring, event.exitcode)
+
+    def ignore(event):
+        pass
+
+    def unknown(event):
+        logger.error("Unknown event: %s", event)
+
+    # The handlers which apply to an event, in order, up to and including the
+    # first one which finishes with it. Which of them apply to a given event
+    # class is only worked out the first time it is seen, ignored classes
+    # then map straight to no handlers at all.
+    handlers = [
+        (bb.build.TaskStarted, task_started, False),
+        (bb.build.TaskSucceeded, task_finished, False),
+        (bb.build.TaskFailed, task_finished, False),
+        (bb.runqueue.runQueueExitWait, exit_wait, True),
+        (bb.event.LogExecTTY, exec_tty, True),
+        (logging.LogRecord, log_record, True),
+        (bb.build.TaskFailedSilent, task_failed_silent, True),
+        (bb.build.TaskFailed, task_failed, False),
+        (bb.build.TaskBase, task_message, True),
+        (bb.event.ParseStarted, parse_started, True),
+        (bb.event.ParseProgress, parse_progress if interactive else ignore, True),
+        (bb.event.ParseCompleted, parse_completed, True),
+        (bb.event.CacheLoadStarted, cache_load_started, True),
+        (bb.event.CacheLoadProgress, cache_load_progress if interactive else ignore, True),
+        (bb.event.CacheLoadCompleted, cache_load_completed, True),
+        (bb.command.CommandFailed, command_failed, True),
+        (bb.command.CommandExit, command_exit, True),
+        ((bb.command.CommandCompleted, bb.cooker.CookerExit), command_completed, True),
+        (bb.event.MultipleProviders, multiple_providers, True),
+        (bb.event.NoProvider, no_provider, True),
+        (bb.runqueue.sceneQueueTaskStarted, scene_task_started, True),
+        (bb.runqueue.runQueueTaskStarted, runqueue_task_started, True),
+        (bb.runqueue.runQueueTaskFailed, runqueue_task_failed, True),
+        (bb.runqueue.sceneQueueTaskFailed, scene_task_failed, True),
+        (bb.event.DepTreeGenerated, ignore, True),
+        ((bb.event.BuildBase,
+          bb.event.MetadataEvent,
+          bb.event.StampUpdate,
+          bb.event.ConfigParsed,
+          bb.event.RecipeParsed,
+          bb.event.RecipePreFinalise,
+          bb.runqueue.runQueueEvent,
+          bb.event.OperationStarted,
+          bb.event.OperationCompleted,
+          bb.event.OperationProgress,
+          bb.event.DiskFull), ignore, True),
+    ]
+    # The only events the UI helper keeps track of, it is left out of the
+    # handlers for everything else
+    helperevents = (bb.build.TaskStarted, bb.build.TaskSucceeded, bb.build.TaskFailed,
+                    bb.build.TaskFailedSilent, bb.runqueue.runQueueTaskStarted,
+                    bb.runqueue.sceneQueueTaskStarted)
+    dispatch = {}
+
+    def find_handlers(eventclass):
+        found = []
+        if issubclass(eventclass, helperevents):
+            found.append(helper.eventHandler)
+        for classes, handler, final in handlers:
+            if issubclass(eventclass, classes):
+                if handler is not ignore:
+                    found.append(handler)
+                if final:
+                    break
+        else:
+            found.append(unknown)
+        dispatch[eventclass] = found
+        return found
+
+    # Resolve the classes named in the table before any events arrive, only
+    # subclasses of them are left to be worked out as they turn up
+    for classes, handler, final in handlers:
+        if not isinstance(classes, tuple):
+            classes = (classes,)
+        for eventclass in classes:
+            if eventclass not in dispatch:
+                find_handlers(eventclass)
+
+    waitEvent = eventHandler.waitEvent
+    getHandlers = dispatch.get
+    # Once a wait has timed out there is no point polling again before the
+    # next one, go straight back to waiting
+    idle = False
     while True:
         try:
-            event = eventHandler.waitEvent(0)
+            if idle:
+                event = None
+            else:
+                event = waitEvent(0)
             if event is None:
                 if main.shutdown > 1:
                     break
+                if not interactive:
+                    sys.stdout.flush()
+                if consolelogbuffer:
+                    consolelogbuffer.flush()
                 termfilter.updateFooter()
-                event = eventHandler.waitEvent(0.25)
-                if stdin_mgr.poll():
-                    keyinput = sys.stdin.read(1)
+                event = waitEvent(0.25)
+                for keyinput in stdin_mgr.readPending():
                     termfilter.clearFooter()
                     if (rtloglevel.setLevel(keyinput, True)):
                         termfilter.updateFooterForce()
 
                 # Always try printing any accumulated log files first
                 rtloglevel.displayLogs()
-                if event is None:
+                idle = event is None
+                if idle:
                     continue
 
-            helper.eventHandler(event)
-            if isinstance(event, bb.build.TaskStarted):
-                if (rtloglevel.displayLogLocations):
-                    termfilter.clearFooter()
-                    print "NOTE: LOG: %s" % event.logfile
-                mlt.openLog(event.logfile, event.pid)
-                rtloglevel.displayLogs()
-
-            if isinstance(event, bb.build.TaskSucceeded):
-                mlt.closeLogPid(event.pid)
-
-            if isinstance(event, bb.build.TaskFailed):
-                mlt.closeLogPid(event.pid)
-
-            if isinstance(event, bb.runqueue.runQueueExitWait):
-                if not main.shutdown:
-                    main.shutdown = 1
-                continue
-            if isinstance(event, bb.event.LogExecTTY):
-                if log_exec_tty:
-                    tries = event.retries
-                    while tries:
-                        print("Trying to run: %s" % event.prog)
-                        if os.system(event.prog) == 0:
-                            break
-                        time.sleep(event.sleep_delay)
-                        tries -= 1
-                    if tries:
-                        continue
-                logger.warn(event.msg)
-                continue
-
-            if isinstance(event, logging.LogRecord):
-                if event.levelno >= format.ERROR:
-                    errors = errors + 1
-                    return_value = 1
-                elif event.levelno == format.WARNING:
-                    warnings = warnings + 1
-                # For "normal" logging conditions, don't show note logs from tasks
-                # but do show them if the user has changed the default log level to
-                # include verbose/debug messages
-                if event.taskpid != 0 and event.levelno <= format.NOTE and (event.levelno < llevel or (event.levelno == format.NOTE and llevel != format.VERBOSE)):
-                    continue
-                logger.handle(event)
-                continue
-
-            if isinstance(event, bb.build.TaskFailedSilent):
-                logger.warn("Logfile for failed setscene task is %s" % event.logfile)
-                continue
-            if isinstance(event, bb.build.TaskFailed):
-                return_value = 1
-                logfile = event.logfile
-                if logfile and os.path.exists(logfile):
-                    termfilter.clearFooter()
-                    bb.error("Logfile of failure stored in: %s" % logfile)
-                    if includelogs and not event.errprinted:
-                        print("Log data follows:")
-                        f = open(logfile, "r")
-                        lines = []
-                        while True:
-                            l = f.readline()
-                            if l == '':
-                                break
-                            l = l.rstrip()
-                            if loglines:
-                                lines.append(' | %s' % l)
-                                if len(lines) > int(loglines):
-                                    lines.pop(0)
-                            else:
-                                print('| %s' % l)
-                        f.close()
-                        if lines:
-                            for line in lines:
-                                print(line)
-            if isinstance(event, bb.build.TaskBase):
-                logger.info(event._message)
-                continue
-            if isinstance(event, bb.event.ParseStarted):
-                if event.total == 0:
-                    continue
-                parseprogress = new_progress("Parsing recipes", event.total).start()
-                continue
-            if isinstance(event, bb.event.ParseProgress):
-                parseprogress.update(event.current)
-                continue
-            if isinstance(event, bb.event.ParseCompleted):
-                if not parseprogress:
-                    continue
-
-                parseprogress.finish()
-                print(("Parsing of %d .bb files complete (%d cached, %d parsed). %d targets, %d skipped, %d masked, %d errors."
-                    % ( event.total, event.cached, event.parsed, event.virtuals, event.skipped, event.masked, event.errors)))
-                continue
-
-            if isinstance(event, bb.event.CacheLoadStarted):
-                cacheprogress = new_progress("Loading cache", event.total).start()
-                continue
-            if isinstance(event, bb.event.CacheLoadProgress):
-                cacheprogress.update(event.current)
-                continue
-            if isinstance(event, bb.event.CacheLoadCompleted):
-                cacheprogress.finish()
-                print("Loaded %d entries from dependency cache." % event.num_entries)
-                continue
-
-            if isinstance(event, bb.command.CommandFailed):
-                return_value = event.exitcode
-                if event.error:
-                    errors = errors + 1
-                    logger.error("Command execution failed: %s", event.error)
-                main.shutdown = 2
-                continue
-            if isinstance(event, bb.command.CommandExit):
-                if not return_value:
-                    return_value = event.exitcode
-                continue
-            if isinstance(event, (bb.command.CommandCompleted, bb.cooker.CookerExit)):
-                main.shutdown = 2
-                continue
-            if isinstance(event, bb.event.MultipleProviders):
-                logger.info("multiple providers are available for %s%s (%s)", event._is_runtime and "runtime " or "",
-                            event._item,
-                            ", ".join(event._candidates))
-                logger.info("consider defining a PREFERRED_PROVIDER entry to match %s", event._item)
-                continue
-            if isinstance(event, bb.event.NoProvider):
-                return_value = 1
-                errors = errors + 1
-                if event._runtime:
-                    r = "R"
-                else:
-                    r = ""
-
-                extra = ''
-                if not event._reasons:
-                    if event._close_matches:
-                        extra = ". Close matches:\n  %s" % '\n  '.join(event._close_matches)
-
-                if event._dependees:
-                    logger.error("Nothing %sPROVIDES '%s' (but %s %sDEPENDS on or otherwise requires it)%s", r, event._item, ", ".join(event._dependees), r, extra)
-                else:
-                    logger.error("Nothing %sPROVIDES '%s'%s", r, event._item, extra)
-                if event._reasons:
-                    for reason in event._reasons:
-                        logger.error("%s", reason)
-                continue
-
-            if isinstance(event, bb.runqueue.sceneQueueTaskStarted):
-                logger.info("Running setscene task %d of %d (%s)" % (event.stats.completed + event.stats.active + event.stats.failed + 1, event.stats.total, event.taskstring))
-                continue
-
-            if isinstance(event, bb.runqueue.runQueueTaskStarted):
-                if event.noexec:
-                    tasktype = 'noexec task'
-                else:
-                    tasktype = 'task'
-                logger.info("Running %s %s of %s (ID: %s, %s)",
-                            tasktype,
-                            event.stats.completed + event.stats.active +
-                                event.stats.failed + 1,
-                            event.stats.total, event.taskid, event.taskstring)
-                continue
-
-            if isinstance(event, bb.runqueue.runQueueTaskFailed):
-                taskfailures.append(event.taskstring)
-                logger.error("Task %s (%s) failed with exit code '%s'",
-                             event.taskid, event.taskstring, event.exitcode)
-                continue
-
-            if isinstance(event, bb.runqueue.sceneQueueTaskFailed):
-                logger.warn("Setscene task %s (%s) failed with exit code '%s' - real task will be run instead",
-                             event.taskid, event.taskstring, event.exitcode)
-                continue
-
-            if isinstance(event, bb.event.DepTreeGenerated):
-                continue
-
-            # ignore
-            if isinstance(event, (bb.event.BuildBase,
-                                  bb.event.MetadataEvent,
-                                  bb.event.StampUpdate,
-                                  bb.event.ConfigParsed,
-                                  bb.event.RecipeParsed,
-                                  bb.event.RecipePreFinalise,
-                                  bb.runqueue.runQueueEvent,
-                                  bb.event.OperationStarted,
-                                  bb.event.OperationCompleted,
-                                  bb.event.OperationProgress,
-                                  bb.event.DiskFull)):
-                continue
-
-            logger.error("Unknown event: %s", event)
+            eventhandlers = getHandlers(type(event))
+            if eventhandlers is None:
+                eventhandlers = find_handlers(type(event))
+            for handler in eventhandlers:
+                handler(event)
 
         except EnvironmentError as ioerror:
             termfilter.clearFooter()
@@ -714,23 +888,23 @@ def main(server, eventHandler, params, tf = TerminalFilter):
             main.shutdown = 2
     stdin_mgr.restore()
     summary = ""
-    if taskfailures:
+    if status.taskfailures:
         summary += pluralise("\nSummary: %s task failed:",
-                             "\nSummary: %s tasks failed:", len(taskfailures))
-        for failure in taskfailures:
+                             "\nSummary: %s tasks failed:", len(status.taskfailures))
+        for failure in status.taskfailures:
             summary += "\n  %s" % failure
-    if warnings:
+    if status.warnings:
         summary += pluralise("\nSummary: There was %s WARNING message shown.",
-                             "\nSummary: There were %s WARNING messages shown.", warnings)
-    if return_value and errors:
+                             "\nSummary: There were %s WARNING messages shown.", status.warnings)
+    if status.return_value and status.errors:
         summary += pluralise("\nSummary: There was %s ERROR message shown, returning a non-zero exit code.",
-                             "\nSummary: There were %s ERROR messages shown, returning a non-zero exit code.", errors)
+                             "\nSummary: There were %s ERROR messages shown, returning a non-zero exit code.", status.errors)
     if summary:
         print(summary)
 
     if interrupted:
         print("Execution was interrupted, returning a non-zero exit code.")
-        if return_value == 0:
-            return_value = 1
+        if status.return_value == 0:
+            status.return_value = 1
 
-    return return_value
+    return status.return_value